@@ -1,14 +1,16 @@
 import os
+import asyncio
+import time
+from typing import Any, Optional
 from pydantic import Json
-import aiohttp
 from aiohttp import BasicAuth
 import datetime
 import uuid
 from pydantic import BaseModel, Field
 
-from supabase_py_async import AsyncClient
-from helpers import extract_numbers, fetch_and_upload_file
+from helpers import extract_numbers
 from logger import async_logger
+import http_sessions
 import twilio_messaging
 
 from mongo.db_ops import ChatManager
@@ -25,31 +27,101 @@ class Contact(BaseModel):
     identification: int
     mobile_number: MobileNumber = Field(..., alias="mobileNumber")
 
-async def get_access_token():
-    url = 'https://api.b2chat.io/oauth/token'
-    auth = BasicAuth(user, pwd) 
-    data = {
-        'grant_type': 'client_credentials'
-    }
-    headers = {
-        'Content-Type': 'application/x-www-form-urlencoded'
-    }
+class B2ChatTokenManager:
+    """
+    Caches the B2Chat client-credentials token until shortly before it expires.
+    Concurrent callers share a single in-flight token request and the token is
+    refreshed in the background before it runs out.
+    """
+
+    def __init__(self, refresh_margin: float = 60):
+        self.refresh_margin = refresh_margin
+        self._token: Optional[str] = None
+        self._expires_at = 0.0
+        self._inflight: Optional[asyncio.Task] = None
+        self._refresh_task: Optional[asyncio.Task] = None
+
+    async def get_token(self) -> Optional[str]:
+        if self._token and time.monotonic() < self._expires_at - self.refresh_margin:
+            return self._token
+        return await self.refresh()
+
+    async def refresh(self) -> Optional[str]:
+        if self._inflight is None or self._inflight.done():
+            self._inflight = asyncio.create_task(self._fetch_token())
+        return await asyncio.shield(self._inflight)
+
+    def invalidate(self, token: Optional[str]):
+        """Drops the cached token, unless it was already replaced by a newer one."""
+        if token == self._token:
+            self._token = None
+            self._expires_at = 0.0
+
+    async def close(self):
+        if self._refresh_task is not None:
+            self._refresh_task.cancel()
+
+    async def _fetch_token(self) -> Optional[str]:
+        url = 'https://api.b2chat.io/oauth/token'
+        auth = BasicAuth(user, pwd)
+        data = {
+            'grant_type': 'client_credentials'
+        }
+        headers = {
+            'Content-Type': 'application/x-www-form-urlencoded'
+        }
 
-    async with aiohttp.ClientSession() as session:
+        session = http_sessions.get_session("b2chat")
         async with session.post(url, data=data, auth=auth, headers=headers) as response:
-            if response.status == 200:
-                json_response = await response.json()
-                return json_response.get('access_token')
-            else:
+            if response.status != 200:
                 await async_logger.error(f"b2chat.get_access_token() response:{response.status}")
-                return f"Error: {response.status}"
+                return None
+            json_response = await response.json()
+
+        self._token = json_response.get('access_token')
+        expires_in = float(json_response.get('expires_in', 3600))
+        self._expires_at = time.monotonic() + expires_in
+        self._schedule_refresh(max(expires_in - 2 * self.refresh_margin, self.refresh_margin))
+        return self._token
+
+    def _schedule_refresh(self, delay: float):
+        if self._refresh_task is not None and not self._refresh_task.done():
+            self._refresh_task.cancel()
+        self._refresh_task = asyncio.create_task(self._refresh_later(delay))
+
+    async def _refresh_later(self, delay: float):
+        await asyncio.sleep(delay)
+        try:
+            await self.refresh()
+        except Exception as error:
+            await async_logger.warning(f"b2chat background token refresh failed: {error}")
+
+token_manager = B2ChatTokenManager(float(os.environ.get('B2C_TOKEN_REFRESH_MARGIN', 60)))
+
+async def get_access_token() -> Optional[str]:
+    return await token_manager.get_token()
+
+async def post_authorized(url: str, data: dict) -> tuple[int, Any]:
+    """
+    Posts JSON to the B2Chat API with the cached bearer token. On a 401 the token
+    is invalidated and the request is retried once with a fresh one.
+    """
+    session = http_sessions.get_session("b2chat")
+    for attempt in range(2):
+        access_token = await get_access_token()
+        headers = {
+            'Content-Type': 'application/json',
+            'Authorization': f'Bearer {access_token}'
+        }
+        async with session.post(url, headers=headers, json=data) as response:
+            if response.status == 401 and attempt == 0:
+                token_manager.invalidate(access_token)
+                continue
+            json_response = await response.json(content_type=None)
+            return response.status, json_response
 
-async def post_chat(access_token: str, chat_id, contact: Contact, initial_msg: str):
+async def post_chat(chat_id, contact: Contact, initial_msg: str):
     url = f'https://api.b2chat.io/bots/{chat_id}/chat' if chat_id else 'https://api.b2chat.io/bots/chat'
-    headers = {
-        'Content-Type': 'application/json',
-        'Authorization': f'Bearer {access_token}'
-    }
     now = datetime.datetime.now()
     formatted_time = int(now.timestamp())
     unique_id = str(uuid.uuid4())
@@ -94,19 +166,15 @@ async def post_chat(access_token: str, chat_id, contact: Contact, initial_msg: s
         }
 
     
-    async with aiohttp.ClientSession() as session:
-        async with session.post(url, headers=headers, json=data) as response:
-            print(f"Raw \n\n: {headers} {data}")
-            json_response = await response.json()
-            if response.status in [200, 201]:
-                return json_response
-            else:
-                await async_logger.error(f"b2chat.post_chat() response:{json_response}")
-                return None 
+    print(f"Raw \n\n: {data}")
+    status, json_response = await post_authorized(url, data)
+    if status in [200, 201]:
+        return json_response
+    else:
+        await async_logger.error(f"b2chat.post_chat() response:{json_response}")
+        return None 
 
 async def agent_handover(chat_manager: ChatManager, dni_number: str, conversation_id: str, initial_msg: str, whatsapp_number: str):
-    access_token = await get_access_token()
-
     ### Check if contact is new
     chat_id = await chat_manager.get_chat_id(conversation_id)
     if not chat_id:
@@ -128,7 +196,7 @@ async def agent_handover(chat_manager: ChatManager, dni_number: str, conversatio
     else:
         contact = None
 
-    response = await post_chat(access_token, chat_id, contact, initial_msg)
+    response = await post_chat(chat_id, contact, initial_msg)
     if response:
         if not chat_id:
             chat_id = response['chat_id']
@@ -136,77 +204,42 @@ async def agent_handover(chat_manager: ChatManager, dni_number: str, conversatio
         else:
             await chat_manager.set_direct_to_agent_true(chat_id) 
     else:
-        twilio_messaging.send_answer_to_client("Estamos enfrentando un problema de nuestra parte, no se pudo abrir la conexión con el agente, estamos investigándolo.", conversation_id)
+        await twilio_messaging.send_answer_to_client("Estamos enfrentando un problema de nuestra parte, no se pudo abrir la conexión con el agente, estamos investigándolo.", conversation_id)
 
 async def post_message_to_agent(chat_manager: ChatManager, msg: str, chat_id: str) -> Json:
-    access_token = await get_access_token()
-    
     url = f'https://api.b2chat.io/bots/{chat_id}/textMessage' 
-    headers = {
-        'Content-Type': 'application/json',
-        'Authorization': f'Bearer {access_token}'
-    }
     data = {
         "text": msg
     }
 
-    async with aiohttp.ClientSession() as session:
-        async with session.post(url, headers=headers, json=data) as response:
-            json_response = await response.json()
-            if response.status in [200, 201]:
-                return json_response
-
-            await async_logger.error(f"b2chat.post_message_to_agent() response:{json_response}")
-            conversation = await chat_manager.get_conversation_number(chat_id)
-            twilio_messaging.send_answer_to_client("Estamos enfrentando un problema de nuestra parte, la conexión con el agente se ha cerrado, estamos investigándolo.", conversation)
-            await chat_manager.set_direct_to_agent_false(chat_id)
+    status, json_response = await post_authorized(url, data)
+    if status in [200, 201]:
+        return json_response
 
-async def post_image_to_agent(chat_manager: ChatManager, image_url: str, chat_id: str, client, supabase_url: str) -> Json:
-    access_token = await get_access_token()
+    await async_logger.error(f"b2chat.post_message_to_agent() response:{json_response}")
+    conversation = await chat_manager.get_conversation_number(chat_id)
+    await twilio_messaging.send_answer_to_client("Estamos enfrentando un problema de nuestra parte, la conexión con el agente se ha cerrado, estamos investigándolo.", conversation)
+    await chat_manager.set_direct_to_agent_false(chat_id)
 
-    uploaded_url = await fetch_and_upload_file(image_url, "wap_images", client, supabase_url)
-    
-    url = f'https://api.b2chat.io/bots/{chat_id}/sendImage' 
-    headers = {
-        'Content-Type': 'application/json',
-        'Authorization': f'Bearer {access_token}'
-    }
+async def _send_media_to_agent(chat_manager: ChatManager, endpoint: str, uploaded_url: Optional[str], chat_id: str) -> Json:
+    url = f'https://api.b2chat.io/bots/{chat_id}/{endpoint}' 
     data = {
         "url": uploaded_url 
     }
 
-    async with aiohttp.ClientSession() as session:
-        async with session.post(url, headers=headers, json=data) as response:
-            json_response = await response.json()
-            if response.status in [200, 201]:
-                return json_response
-
-            await async_logger.error(f"b2chat.post_image_to_agent() response:{json_response}")
-            conversation = await chat_manager.get_conversation_number(chat_id)
-            twilio_messaging.send_answer_to_client("Estamos enfrentando un problema de nuestra parte, la conexión con el agente se ha cerrado, estamos investigándolo.", conversation)
-            await chat_manager.set_direct_to_agent_false(chat_id)
-
-async def post_file_to_agent(chat_manager: ChatManager, file_url: str, chat_id: str, client: AsyncClient, supabase_url: str) -> Json:
-    access_token = await get_access_token()
+    status, json_response = await post_authorized(url, data)
+    if status in [200, 201]:
+        return json_response
 
-    uploaded_url = await fetch_and_upload_file(file_url, "wap_files", client, supabase_url)
-    
-    url = f'https://api.b2chat.io/bots/{chat_id}/sendFile' 
-    headers = {
-        'Content-Type': 'application/json',
-        'Authorization': f'Bearer {access_token}'
-    }
-    data = {
-        "url": uploaded_url
-    }
+    await async_logger.error(f"b2chat.{endpoint}() response:{json_response}")
+    conversation = await chat_manager.get_conversation_number(chat_id)
+    await twilio_messaging.send_answer_to_client("Estamos enfrentando un problema de nuestra parte, la conexión con el agente se ha cerrado, estamos investigándolo.", conversation)
+    await chat_manager.set_direct_to_agent_false(chat_id)
 
-    async with aiohttp.ClientSession() as session:
-        async with session.post(url, headers=headers, json=data) as response:
-            json_response = await response.json()
-            if response.status in [200, 201]:
-                return json_response
+async def send_image_to_agent(chat_manager: ChatManager, uploaded_url: Optional[str], chat_id: str) -> Json:
+    """Posts an image already uploaded to Supabase storage to the agent chat."""
+    return await _send_media_to_agent(chat_manager, "sendImage", uploaded_url, chat_id)
 
-            await async_logger.error(f"b2chat.post_file_to_agent() response:{json_response}")
-            conversation = await chat_manager.get_conversation_number(chat_id)
-            twilio_messaging.send_answer_to_client("Estamos enfrentando un problema de nuestra parte, la conexión con el agente se ha cerrado, estamos investigándolo.", conversation)
-            await chat_manager.set_direct_to_agent_false(chat_id)
+async def send_file_to_agent(chat_manager: ChatManager, uploaded_url: Optional[str], chat_id: str) -> Json:
+    """Posts a file already uploaded to Supabase storage to the agent chat."""
+    return await _send_media_to_agent(chat_manager, "sendFile", uploaded_url, chat_id)
@@ -0,0 +1,34 @@
+import asyncio
+import traceback
+from typing import Coroutine
+from logger import async_logger
+
+_tasks: set[asyncio.Task] = set()
+
+def spawn(coro: Coroutine, name: str = None) -> asyncio.Task:
+    """
+    Runs a coroutine in the background, keeping a strong reference to the task so it
+    isn't garbage collected and logging any exception it raises.
+    """
+    task = asyncio.create_task(coro, name=name)
+    _tasks.add(task)
+    task.add_done_callback(_on_done)
+    return task
+
+def _on_done(task: asyncio.Task):
+    _tasks.discard(task)
+    if task.cancelled():
+        return
+    exc = task.exception()
+    if exc is not None:
+        exc_traceback = ''.join(traceback.format_exception(type(exc), exc, exc.__traceback__))
+        asyncio.ensure_future(async_logger.error(f"Background task {task.get_name()} failed: {exc_traceback}"))
+
+async def shutdown(timeout: float = 10):
+    """Gives pending background tasks a chance to finish, then cancels the rest."""
+    if not _tasks:
+        return
+    _, pending = await asyncio.wait(set(_tasks), timeout=timeout)
+    for task in pending:
+        task.cancel()
+    await asyncio.gather(*pending, return_exceptions=True)
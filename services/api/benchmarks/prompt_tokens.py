@@ -0,0 +1,36 @@
+"""
+Token count per prompt section of the split support prompts.
+
+    python benchmarks/prompt_tokens.py
+
+The system section is the part that is identical on every call and can be served from the
+provider's prompt cache, the other sections are paid in full on every turn.
+"""
+import os
+import sys
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from chains import prompt_token_report, prompt_version
+
+SAMPLE_HISTORY = "Human: hola\nAI: ¡Hola! ¿En qué puedo ayudarte hoy?\nHuman: cuánto debo?\nAI: Por favor indícame tu Número de cédula."
+SAMPLE_MESSAGE = "8-123-4567"
+SAMPLE_CONTEXT = {
+    "total_debt": "250.00", "remaining_payment_installments": "6", "next_payment_due_date": "15/06/2024",
+    "account_summary": "Cuenta al día", "cost_of_interest_in_usd": "40.00", "total_loan_including_interest": "340.00",
+    "payment_frequency": "Quincenal", "account_status": "Activa", "total_paid_and_total_to_pay": "90.00 / 340.00",
+    "first_payment_date": "01/03/2024", "most_recent_payment": "01/05/2024", "possibility_of_extension": "No",
+    "user_next_payment_amount": "41.66",
+}
+
+if __name__ == "__main__":
+    samples = {
+        "dni_conversation": {"history": SAMPLE_HISTORY, "message": SAMPLE_MESSAGE},
+        "support_conversation": {"history": SAMPLE_HISTORY, "message": SAMPLE_MESSAGE, "user_context": SAMPLE_CONTEXT},
+    }
+    for name, variables in samples.items():
+        report = prompt_token_report(name, **variables)
+        print(f"{name} (version {prompt_version(name)})")
+        for section, tokens in report.items():
+            share = tokens / report["total"]
+            print(f"  {section:<14} {tokens:>6} tokens  {share:>5.0%}")
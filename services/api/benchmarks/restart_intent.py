@@ -0,0 +1,120 @@
+"""
+Offline benchmark of the local restart-intent detector against the labelled examples below.
+
+    python benchmarks/restart_intent.py          # local detector only
+    python benchmarks/restart_intent.py --llm    # also runs chains.indicate_intent_restart (needs OPENAI_API_KEY)
+
+Ambiguous local answers are reported separately, in the combined column they are
+resolved by the LLM chain exactly like execute_message does.
+
+The examples are hand written, partly against the detector's own patterns, so good numbers
+here only show that known phrasings keep working. Add misclassified messages from real
+traffic whenever they turn up.
+"""
+import os
+import sys
+import asyncio
+import argparse
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from intent import detect_restart
+
+# (message, wants to restart the chat)
+LABELLED = [
+    ("reiniciar", True),
+    ("Reiniciar chat", True),
+    ("quiero reiniciar la conversación", True),
+    ("reinicia el chat por favor", True),
+    ("empezar de nuevo", True),
+    ("Podemos empezar de nuevo?", True),
+    ("quiero comenzar de nuevo la conversacion", True),
+    ("volver a empezar", True),
+    ("borrar chat", True),
+    ("Borra la conversación", True),
+    ("elimina el historial del chat", True),
+    ("nuevo chat", True),
+    ("restart", True),
+    ("reset", True),
+    ("empecemos desde cero", True),
+    ("limpia los mensajes y empezamos otra vez", True),
+    ("hola", False),
+    ("Buenas tardes, quiero saber cuánto debo", False),
+    ("cuál es mi próxima fecha de pago?", False),
+    ("como pago con yappy", False),
+    ("mi cédula es 8-123-4567", False),
+    ("necesito la clave para desbloquear mi celular", False),
+    ("como reinicio mi celular?", False),
+    ("se me reinició el teléfono y ahora está bloqueado", False),
+    ("quiero borrar mi cuenta", False),
+    ("me robaron el teléfono", False),
+    ("ya hice el pago ayer por western union", False),
+    ("quiero un préstamo personal", False),
+    ("soy empleado del sector público", False),
+    ("el pin no funciona, ya reinicié el equipo dos veces", False),
+    ("donde están las tiendas", False),
+    ("quiero extender el plazo de pago", False),
+    ("gracias", False),
+    ("ok", False),
+    ("necesito hablar con un agente", False),
+    ("la información de mi cuenta está mal", False),
+    ("pueden volver a enviarme el código", False),
+    ("quiero la carta de cancelación", False),
+    ("empecé a pagar en enero y quiero saber cuánto me falta", False),
+    ("nuevo cliente, quiero un celular", False),
+    # Credit vocabulary next to a restart cue
+    ("borrar el historial de pagos", False),
+    ("necesito limpiar el historial de mi credito", False),
+    ("quiero borrar mis mensajes", False),
+    ("quiero ver mi historial crediticio", False),
+    ("como limpio mi historial crediticio", False),
+    ("pueden eliminar el cobro duplicado", False),
+    ("quiero empezar de nuevo a pagar mi deuda", False),
+    ("se puede reiniciar el plan de pagos?", False),
+    ("borren la mora de mi cuenta", False),
+    ("elimina el historial de cuotas atrasadas", False),
+    # Negated, questions and past tense, they describe a restart instead of asking for one
+    ("no reinicies el chat", False),
+    ("no quiero borrar el chat", False),
+    ("no quiero empezar de nuevo", False),
+    ("nunca pedí reiniciar la conversación", False),
+    ("no borres la conversación por favor", False),
+    ("por qué se reinició el chat?", False),
+    ("el chat se reinició solo", False),
+    ("se borró la conversación", False),
+    ("reiniciaste el chat?", False),
+    ("quién borró el chat?", False),
+    ("que pasó con el chat, se reseteó", False),
+]
+
+def report(name: str, predictions: list[bool]):
+    tp = sum(1 for (_, label), pred in zip(LABELLED, predictions) if label and pred)
+    fp = sum(1 for (_, label), pred in zip(LABELLED, predictions) if not label and pred)
+    fn = sum(1 for (_, label), pred in zip(LABELLED, predictions) if label and not pred)
+    precision = tp / (tp + fp) if tp + fp else 1.0
+    recall = tp / (tp + fn) if tp + fn else 1.0
+    print(f"{name:<10} precision={precision:.2f} recall={recall:.2f} (tp={tp} fp={fp} fn={fn})")
+
+async def main(use_llm: bool):
+    local = [detect_restart(message) for message, _ in LABELLED]
+    ambiguous = [message for (message, _), answer in zip(LABELLED, local) if answer is None]
+    print(f"{len(LABELLED)} examples, {len(ambiguous)} ambiguous locally ({len(ambiguous) / len(LABELLED):.0%} would still call the LLM)")
+
+    # Ambiguous counts as "no restart" for the local-only numbers
+    report("local", [answer == "Y" for answer in local])
+
+    if use_llm:
+        import chains
+        llm = await asyncio.gather(*(chains.indicate_intent_restart(message) for message, _ in LABELLED))
+        llm = [answer.strip().upper() == "Y" for answer in llm]
+        report("llm", llm)
+        report("combined", [answer == "Y" if answer is not None else llm_answer for answer, llm_answer in zip(local, llm)])
+
+    for (message, label), answer in zip(LABELLED, local):
+        if answer is not None and (answer == "Y") != label:
+            print(f"  wrong: {message!r} -> {answer}")
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--llm", action="store_true", help="also evaluate the current LLM chain")
+    asyncio.run(main(parser.parse_args().llm))
@@ -0,0 +1,49 @@
+import time
+from collections import OrderedDict
+from typing import Any, Hashable, Optional
+
+class TTLCache:
+    """
+    Size bounded LRU cache whose entries expire after a per-entry ttl.
+
+    Expired entries are kept for an additional `stale_ttl` seconds so callers can
+    serve them while a refresh runs (stale-while-revalidate).
+    """
+
+    def __init__(self, maxsize: int, ttl: float, stale_ttl: float = 0):
+        self.maxsize = maxsize
+        self.ttl = ttl
+        self.stale_ttl = stale_ttl
+        self._data: OrderedDict[Hashable, tuple[Any, float]] = OrderedDict()
+
+    def get(self, key: Hashable) -> tuple[Optional[Any], bool]:
+        """
+        :return: (value, is_fresh). value is None when the key is missing or past its stale window.
+        """
+        entry = self._data.get(key)
+        if entry is None:
+            return None, False
+
+        value, expires_at = entry
+        now = time.monotonic()
+        if now >= expires_at + self.stale_ttl:
+            del self._data[key]
+            return None, False
+
+        self._data.move_to_end(key)
+        return value, now < expires_at
+
+    def set(self, key: Hashable, value: Any, ttl: Optional[float] = None):
+        self._data[key] = (value, time.monotonic() + (self.ttl if ttl is None else ttl))
+        self._data.move_to_end(key)
+        while len(self._data) > self.maxsize:
+            self._data.popitem(last=False)
+
+    def pop(self, key: Hashable):
+        self._data.pop(key, None)
+
+    def clear(self):
+        self._data.clear()
+
+    def __len__(self):
+        return len(self._data)
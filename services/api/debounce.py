@@ -0,0 +1,275 @@
+import os
+import asyncio
+import heapq
+import itertools
+import socket
+import time
+import uuid
+from datetime import datetime, timedelta
+from typing import Awaitable, Callable, Optional
+
+from pymongo import ReturnDocument
+from pymongo.errors import DuplicateKeyError
+
+from mongo.db_ops import MongoDBManager
+import background
+import metrics
+from logger import async_logger
+
+DEBOUNCE_WINDOW = float(os.environ.get('DEBOUNCE_WINDOW', 16))
+DEBOUNCE_MAX_WAIT = float(os.environ.get('DEBOUNCE_MAX_WAIT', 60))
+DEBOUNCE_MAX_INFLIGHT = int(os.environ.get('DEBOUNCE_MAX_INFLIGHT', 32))
+DEBOUNCE_SHARDS = int(os.environ.get('DEBOUNCE_SHARDS', 64))
+DEBOUNCE_LEASE = float(os.environ.get('DEBOUNCE_LEASE', 120))
+DEBOUNCE_SWEEP_INTERVAL = float(os.environ.get('DEBOUNCE_SWEEP_INTERVAL', 30))
+
+WORKER_ID = f"{socket.gethostname()}-{os.getpid()}-{uuid.uuid4().hex[:8]}"
+
+_shard_locks = [asyncio.Lock() for _ in range(DEBOUNCE_SHARDS)]
+
+def shard_lock(sender_id: str) -> asyncio.Lock:
+    """Per-sender state is guarded by one of DEBOUNCE_SHARDS locks instead of a single global one."""
+    return _shard_locks[hash(sender_id) % len(_shard_locks)]
+
+class InMemoryDebounceBackend:
+    """
+    Buffers the messages of each sender in this process only. Correct as long as
+    every message of a sender reaches the same worker; buffered messages are lost on
+    a restart although their webhook job already completed.
+    """
+
+    def __init__(self, window: float = DEBOUNCE_WINDOW, max_wait: float = DEBOUNCE_MAX_WAIT):
+        self.window = window
+        self.max_wait = max_wait
+        self._buffers: dict[str, dict] = {}
+
+    async def append(self, sender_id: str, message: dict) -> float:
+        """
+        Adds a message to the sender's buffer and returns the new flush deadline (epoch seconds).
+        The deadline moves back by `window` with every message, but never past `max_wait`
+        after the first buffered message.
+        """
+        now = time.time()
+        async with shard_lock(sender_id):
+            buffer = self._buffers.setdefault(sender_id, {'messages': [], 'first_seen': now})
+            buffer['messages'].append({**message, 'id': uuid.uuid4().hex})
+            buffer['deadline'] = min(now + self.window, buffer['first_seen'] + self.max_wait)
+            return buffer['deadline']
+
+    async def claim(self, sender_id: str) -> Optional[list[dict]]:
+        """Takes ownership of the sender's buffered messages once the deadline has passed."""
+        async with shard_lock(sender_id):
+            buffer = self._buffers.get(sender_id)
+            if buffer is None or buffer['deadline'] > time.time():
+                return None
+            del self._buffers[sender_id]
+        return buffer['messages']
+
+    async def complete(self, sender_id: str, messages: list[dict]) -> Optional[float]:
+        return None
+
+    async def discard(self, sender_id: str):
+        async with shard_lock(sender_id):
+            self._buffers.pop(sender_id, None)
+
+    async def due_senders(self) -> list[str]:
+        now = time.time()
+        return [sender_id for sender_id, buffer in list(self._buffers.items()) if buffer['deadline'] <= now]
+
+class MongoDebounceBackend:
+    """
+    Buffers messages in the `message-buffer` collection so consecutive messages of a
+    sender are batched even when they land on different gunicorn workers.
+
+    Every append pushes the deadline back. The worker whose timer fires after the
+    deadline takes a lease on the buffer, processes the claimed messages and then
+    removes only those, so messages arriving meanwhile wait for the next flush.
+    A crashed worker's lease expires and the sweeper picks the buffer up again.
+    """
+
+    def __init__(self, db: MongoDBManager, window: float = DEBOUNCE_WINDOW, max_wait: float = DEBOUNCE_MAX_WAIT, lease: float = DEBOUNCE_LEASE):
+        self.collection = db.get_collection("message-buffer")
+        self.window = window
+        self.max_wait = max_wait
+        self.lease = lease
+
+    async def ensure_indexes(self):
+        await self.collection.create_index([("sender_id", 1)], unique=True)
+        await self.collection.create_index([("deadline", 1)])
+
+    async def append(self, sender_id: str, message: dict) -> float:
+        now = datetime.utcnow()
+        # Pipeline update so the max-wait cap is computed atomically from the stored first_seen
+        update = [
+            {"$set": {
+                "first_seen": {"$ifNull": ["$first_seen", now]},
+                "messages": {"$concatArrays": [
+                    {"$ifNull": ["$messages", []]},
+                    [{"$literal": {**message, 'id': uuid.uuid4().hex}}],
+                ]},
+            }},
+            {"$set": {"deadline": {"$min": [
+                now + timedelta(seconds=self.window),
+                {"$add": ["$first_seen", int(self.max_wait * 1000)]},
+            ]}}},
+        ]
+        try:
+            document = await self.collection.find_one_and_update(
+                {"sender_id": sender_id}, update, upsert=True, return_document=ReturnDocument.AFTER
+            )
+        except DuplicateKeyError:
+            # Two workers raced on the upsert, the document exists now
+            document = await self.collection.find_one_and_update(
+                {"sender_id": sender_id}, update, return_document=ReturnDocument.AFTER
+            )
+        return time.time() + (document["deadline"] - now).total_seconds()
+
+    async def claim(self, sender_id: str) -> Optional[list[dict]]:
+        now = datetime.utcnow()
+        document = await self.collection.find_one_and_update(
+            {
+                "sender_id": sender_id,
+                "deadline": {"$lte": now},
+                "$or": [{"lease_expires": None}, {"lease_expires": {"$lte": now}}],
+            },
+            {"$set": {"lease_owner": WORKER_ID, "lease_expires": now + timedelta(seconds=self.lease)}},
+            return_document=ReturnDocument.AFTER,
+        )
+        if not document or not document.get("messages"):
+            return None
+        return document["messages"]
+
+    async def complete(self, sender_id: str, messages: list[dict]) -> Optional[float]:
+        """
+        Removes the processed messages and releases the lease. Messages that arrived during
+        the flush start a fresh debounce window; their deadline is returned so the caller can
+        reschedule the sender, the timer that fired during the lease found nothing to claim.
+        """
+        ids = [message['id'] for message in messages]
+        document = await self.collection.find_one_and_update(
+            {"sender_id": sender_id, "lease_owner": WORKER_ID},
+            {"$pull": {"messages": {"id": {"$in": ids}}}, "$unset": {"lease_owner": "", "lease_expires": ""}},
+            return_document=ReturnDocument.AFTER,
+        )
+        if document is None or not document.get("messages"):
+            await self.collection.delete_one({"sender_id": sender_id, "messages": {"$size": 0}, "lease_owner": None})
+            return None
+
+        # The old first_seen would put the max-wait cap in the past and stop debouncing
+        now = datetime.utcnow()
+        wait = min(self.window, self.max_wait)
+        await self.collection.update_one(
+            {"sender_id": sender_id, "lease_owner": None},
+            {"$set": {"first_seen": now, "deadline": now + timedelta(seconds=wait)}},
+        )
+        return time.time() + wait
+
+    async def discard(self, sender_id: str):
+        await self.collection.delete_one({"sender_id": sender_id})
+
+    async def due_senders(self) -> list[str]:
+        now = datetime.utcnow()
+        cursor = self.collection.find(
+            {
+                "deadline": {"$lte": now},
+                "$or": [{"lease_expires": None}, {"lease_expires": {"$lte": now}}],
+            },
+            {"sender_id": 1, "_id": 0},
+        )
+        return [document["sender_id"] async for document in cursor]
+
+class DebounceScheduler:
+    """
+    Fires a flush per sender once its deadline passes. All deadlines live in one heap
+    driven by a single loop task, so rescheduling a sender costs O(log n) instead of
+    cancelling and recreating a sleeping task per message. Superseded heap entries are
+    skipped lazily when they reach the top.
+
+    Flushes run as background tasks, at most `max_inflight` at a time.
+    """
+
+    def __init__(self, flush: Callable[[str], Awaitable[None]], max_inflight: int = DEBOUNCE_MAX_INFLIGHT):
+        self.flush = flush
+        self._heap: list[tuple[float, int, str]] = []
+        self._deadlines: dict[str, float] = {}
+        self._seq = itertools.count()
+        self._wakeup = asyncio.Event()
+        self._inflight = asyncio.Semaphore(max_inflight)
+        self._inflight_count = 0
+
+        metrics.register_gauge("debounce.pending_senders", self.pending_senders)
+        metrics.register_gauge("debounce.inflight_flushes", lambda: self._inflight_count)
+
+    def schedule(self, sender_id: str, deadline: float):
+        """
+        Sets the sender's flush deadline (epoch seconds). Deadlines of a buffer only ever
+        move back, so concurrent appends finishing out of order keep the latest one.
+        """
+        due = time.monotonic() + max(deadline - time.time(), 0)
+        due = max(due, self._deadlines.get(sender_id, due))
+        self._deadlines[sender_id] = due
+        heapq.heappush(self._heap, (due, next(self._seq), sender_id))
+        if self._heap[0][2] == sender_id:
+            self._wakeup.set()
+
+    def cancel(self, sender_id: str):
+        self._deadlines.pop(sender_id, None)
+
+    def pending_senders(self) -> int:
+        return len(self._deadlines)
+
+    async def run(self):
+        while True:
+            if not self._heap:
+                await self._wakeup.wait()
+                self._wakeup.clear()
+                continue
+
+            due, _, sender_id = self._heap[0]
+            delay = due - time.monotonic()
+            if delay > 0:
+                try:
+                    await asyncio.wait_for(self._wakeup.wait(), delay)
+                except asyncio.TimeoutError:
+                    pass
+                self._wakeup.clear()
+                continue
+
+            heapq.heappop(self._heap)
+            if self._deadlines.get(sender_id) != due:
+                continue
+            del self._deadlines[sender_id]
+
+            metrics.observe("debounce.flush_lag", time.monotonic() - due)
+            background.spawn(self._run_flush(sender_id), name="debounce-flush")
+
+    async def _run_flush(self, sender_id: str):
+        async with self._inflight:
+            self._inflight_count += 1
+            try:
+                await self.flush(sender_id)
+            finally:
+                self._inflight_count -= 1
+
+def create_backend(db: MongoDBManager):
+    """
+    The webhook job of a message completes once it is buffered, so the buffer has to be as
+    durable as the job queue: Mongo unless DEBOUNCE_BACKEND=memory is set explicitly.
+    """
+    if os.environ.get('DEBOUNCE_BACKEND', 'mongo') == 'memory':
+        return InMemoryDebounceBackend()
+    return MongoDebounceBackend(db)
+
+async def run_sweeper(backend, scheduler: DebounceScheduler, interval: float = DEBOUNCE_SWEEP_INTERVAL):
+    """
+    Periodically flushes buffers whose deadline passed without any worker picking them
+    up, e.g. because the worker holding the timer restarted. Runs once at startup too.
+    """
+    while True:
+        try:
+            now = time.time()
+            for sender_id in await backend.due_senders():
+                scheduler.schedule(sender_id, now)
+        except Exception as error:
+            await async_logger.error(f"debounce.run_sweeper() failed: {error}")
+        await asyncio.sleep(interval)
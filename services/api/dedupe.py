@@ -0,0 +1,72 @@
+import os
+import json
+import hashlib
+from datetime import datetime
+
+from pymongo.errors import BulkWriteError
+
+from cache import TTLCache
+from mongo.db_ops import MongoDBManager
+import metrics
+
+DEDUPE_TTL = float(os.environ.get('DEDUPE_TTL', 86400))
+DEDUPE_LRU_SIZE = int(os.environ.get('DEDUPE_LRU_SIZE', 20000))
+
+DUPLICATE_KEY_ERROR = 11000
+
+def b2chat_item_key(kind: str, item: dict) -> str:
+    """
+    Identifies one B2Chat message or event. B2Chat ids are used when the item has one,
+    otherwise a hash of the item, which is identical on every redelivery of the payload.
+    """
+    item_id = item.get('id') or item.get('message_id') or item.get('event_id')
+    if item_id is None:
+        item_id = hashlib.sha256(json.dumps(item, sort_keys=True, default=str).encode()).hexdigest()
+    return f"b2chat:{kind}:{item_id}"
+
+class Deduplicator:
+    """
+    Drops redelivered webhooks. Keys seen by this worker are answered from an in-memory
+    LRU; everything else is claimed by inserting it into the `webhook-dedupe` collection,
+    whose unique _id makes exactly one worker win. Documents expire after `ttl` seconds
+    through a TTL index.
+    """
+
+    def __init__(self, db: MongoDBManager, ttl: float = DEDUPE_TTL, lru_size: int = DEDUPE_LRU_SIZE):
+        self.collection = db.get_collection("webhook-dedupe")
+        self.ttl = ttl
+        self._seen = TTLCache(maxsize=lru_size, ttl=ttl)
+
+    async def ensure_indexes(self):
+        await self.collection.create_index([("created_at", 1)], expireAfterSeconds=int(self.ttl))
+
+    async def first_deliveries(self, keys: list[str]) -> set[str]:
+        """Records the keys and returns the ones that had not been seen before."""
+        fresh = [key for key in dict.fromkeys(keys) if self._seen.get(key)[0] is None]
+        metrics.incr("dedupe.duplicates.memory", len(keys) - len(fresh))
+        if not fresh:
+            return set()
+
+        now = datetime.utcnow()
+        duplicates = set()
+        try:
+            await self.collection.insert_many([{"_id": key, "created_at": now} for key in fresh], ordered=False)
+        except BulkWriteError as error:
+            for write_error in error.details.get("writeErrors", []):
+                if write_error["code"] != DUPLICATE_KEY_ERROR:
+                    raise
+                duplicates.add(fresh[write_error["index"]])
+        metrics.incr("dedupe.duplicates.mongo", len(duplicates))
+
+        for key in fresh:
+            self._seen.set(key, True)
+        return set(fresh) - duplicates
+
+    async def first_delivery(self, key: str) -> bool:
+        return key in await self.first_deliveries([key])
+
+    async def forget(self, keys: list[str]):
+        """Releases keys whose processing could not even be queued, so a redelivery is accepted."""
+        for key in keys:
+            self._seen.pop(key)
+        await self.collection.delete_many({"_id": {"$in": keys}})
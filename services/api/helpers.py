@@ -1,13 +1,42 @@
+import os
+import asyncio
 import json
+import hashlib
 import logging
 import re
+import time
 from typing import Any, Optional
-import aiohttp
 import phonenumbers
-import uuid
 import mimetypes
+import tempfile
+import aiofiles
+import aiofiles.os
+import aiohttp
+import httpx
+from storage3.utils import StorageException
+import http_sessions
+import background
+import metrics
+from cache import TTLCache
 from logger import async_logger
 
+CREDITS_PANAMA_SESSION_TTL = float(os.environ.get('CREDITS_PANAMA_SESSION_TTL', 600))
+
+DNI_NOT_FOUND_MSG = "Lo sentimos, no pudimos encontrar ese número de DNI. ¿Podrías verificar si es correcto?"
+
+# Converted account info per DNI, "DNI not found" answers are cached for a shorter time
+user_context_cache = TTLCache(
+    maxsize=int(os.environ.get('USER_CONTEXT_CACHE_SIZE', 5000)),
+    ttl=float(os.environ.get('USER_CONTEXT_CACHE_TTL', 300)),
+    stale_ttl=float(os.environ.get('USER_CONTEXT_CACHE_STALE_TTL', 900)),
+)
+USER_CONTEXT_NEGATIVE_TTL = float(os.environ.get('USER_CONTEXT_NEGATIVE_TTL', 60))
+
+_session_auth: Optional[str] = None
+_session_auth_expires_at = 0.0
+_session_auth_lock = asyncio.Lock()
+_user_context_refreshing: set[str] = set()
+
 def find_dni(text):
     """
     Searches for a DNI number in the provided text.
@@ -50,15 +79,37 @@ async def login(api_key) -> str:
     headers = {
         'Authorization': f'Bearer {api_key}'
     }
-    async with aiohttp.ClientSession() as session:
-        try:
-            async with session.post(login_url, headers=headers) as response:
-                data = await response.text()
-                print('Server response:', data)
-                data_json = json.loads(data)
-                return data_json.get('session_auth')  # Extracting auth token
-        except Exception as error:
-            raise Exception(f'error: {error}')
+    session = http_sessions.get_session("creditspanama")
+    try:
+        async with session.post(login_url, headers=headers) as response:
+            data = await response.text()
+            print('Server response:', data)
+            data_json = json.loads(data)
+            return data_json.get('session_auth')  # Extracting auth token
+    except Exception as error:
+        raise Exception(f'error: {error}')
+
+async def get_session_auth(api_key: str) -> str:
+    """
+    Returns the cached CreditsPanama session token, logging in again once it is older
+    than CREDITS_PANAMA_SESSION_TTL. Concurrent callers wait for a single login.
+    """
+    global _session_auth, _session_auth_expires_at
+    if _session_auth and time.monotonic() < _session_auth_expires_at:
+        return _session_auth
+
+    async with _session_auth_lock:
+        if _session_auth and time.monotonic() < _session_auth_expires_at:
+            return _session_auth
+        _session_auth = await login(api_key)
+        _session_auth_expires_at = time.monotonic() + CREDITS_PANAMA_SESSION_TTL
+        return _session_auth
+
+def invalidate_session_auth(auth_token: Optional[str]):
+    global _session_auth, _session_auth_expires_at
+    if auth_token == _session_auth:
+        _session_auth = None
+        _session_auth_expires_at = 0.0
 
 async def get_user_info(auth_token, dni_number):
     get_user_info_url = "https://lab.creditspanama.com/api/v1/chat_bots/customer"
@@ -69,15 +120,15 @@ async def get_user_info(auth_token, dni_number):
     payload = {
         "dni": dni_number
     }
-    async with aiohttp.ClientSession() as session:
-        try:
-            async with session.post(get_user_info_url, json=payload, headers=headers) as response:
-                data = await response.json()
-                print(f"user info: {data}")
-                # Process and return the relevant data as needed
-                return data
-        except Exception as error:
-            return {"error-fatal": str(error)} 
+    session = http_sessions.get_session("creditspanama")
+    try:
+        async with session.post(get_user_info_url, json=payload, headers=headers) as response:
+            data = await response.json()
+            print(f"user info: {data}")
+            # Process and return the relevant data as needed
+            return data
+    except Exception as error:
+        return {"error-fatal": str(error)} 
 
 async def convert_user_info_to_usable_format(provided_data: dict[str, Any]) -> dict[str, Any]:
     account_info = {
@@ -99,43 +150,187 @@ async def convert_user_info_to_usable_format(provided_data: dict[str, Any]) -> d
     return account_info
 
 async def get_user_context(dni_number: str, api_key: str) -> dict[str, Any]:
-    auth = await login(api_key)
+    """
+    Returns the account info for a DNI, served from user_context_cache when possible.
+    A stale entry is returned immediately and refreshed in the background.
+    """
+    user_context, is_fresh = user_context_cache.get(dni_number)
+    if user_context is not None:
+        if not is_fresh and dni_number not in _user_context_refreshing:
+            _user_context_refreshing.add(dni_number)
+            background.spawn(_refresh_user_context(dni_number, api_key), name="refresh-user-context")
+        return user_context
+
+    return await _fetch_user_context(dni_number, api_key)
+
+def invalidate_user_context(dni_number: Optional[str]):
+    if dni_number:
+        user_context_cache.pop(dni_number)
+
+async def _refresh_user_context(dni_number: str, api_key: str):
+    try:
+        await _fetch_user_context(dni_number, api_key)
+    finally:
+        _user_context_refreshing.discard(dni_number)
+
+async def _fetch_user_context(dni_number: str, api_key: str) -> dict[str, Any]:
+    auth = await get_session_auth(api_key)
     provided_data = await get_user_info(auth, dni_number)
 
+    if 'data' not in provided_data:
+        # The session token may have expired on their side, log in again and retry once
+        invalidate_session_auth(auth)
+        auth = await get_session_auth(api_key)
+        provided_data = await get_user_info(auth, dni_number)
+
     if 'data' in provided_data:
         if 'error' in provided_data['data']:
-            return {"msg": "Lo sentimos, no pudimos encontrar ese número de DNI. ¿Podrías verificar si es correcto?"}
+            user_context = {"msg": DNI_NOT_FOUND_MSG}
+            user_context_cache.set(dni_number, user_context, ttl=USER_CONTEXT_NEGATIVE_TTL)
+            return user_context
         else:
             user_context = await convert_user_info_to_usable_format(provided_data)
     else:
         return {"msg": "Lo sentimos, algo salió mal de nuestra parte. Te derivaremos a un agente lo antes posible.", "msg-agent": "Hubo problemas para conectarse a la API cuando el usuario ingresó su número de DNI."}
 
     print(user_context)
+    user_context_cache.set(dni_number, user_context)
 
     return user_context
 
-async def fetch_and_upload_file(image_url: str, bucket_name: str, client, supabase_url) -> Optional[str]:
-    async with aiohttp.ClientSession() as session:
+MEDIA_MAX_BYTES = int(os.environ.get('MEDIA_MAX_BYTES', 25 * 1024 * 1024))
+MEDIA_CHUNK_SIZE = int(os.environ.get('MEDIA_CHUNK_SIZE', 64 * 1024))
+# Where media is spooled between the Twilio download and the Supabase upload, None is the system default
+MEDIA_SPOOL_DIR = os.environ.get('MEDIA_SPOOL_DIR')
+
+GENERIC_CONTENT_TYPES = {"", "application/octet-stream", "binary/octet-stream", "application/unknown"}
+
+# (offset, magic bytes, content type) of the formats customers send over WhatsApp
+MAGIC_NUMBERS = [
+    (0, b"\xff\xd8\xff", "image/jpeg"),
+    (0, b"\x89PNG\r\n\x1a\n", "image/png"),
+    (0, b"GIF87a", "image/gif"),
+    (0, b"GIF89a", "image/gif"),
+    (8, b"WEBP", "image/webp"),
+    (0, b"%PDF-", "application/pdf"),
+    (0, b"OggS", "audio/ogg"),
+    (0, b"ID3", "audio/mpeg"),
+    (0, b"#!AMR", "audio/amr"),
+    (4, b"ftypM4A", "audio/mp4"),
+    (4, b"ftyp", "video/mp4"),
+]
+MAGIC_HEAD_SIZE = 16
+
+def sniff_content_type(head: bytes, declared: str) -> str:
+    """
+    Content type of a file from its first bytes. The declared type wins unless it is missing
+    or generic, a declared type contradicting the bytes is only counted.
+    """
+    declared = (declared or "").split(";")[0].strip().lower()
+    sniffed = next((content_type for offset, magic, content_type in MAGIC_NUMBERS if head[offset:offset + len(magic)] == magic), None)
+    if declared in GENERIC_CONTENT_TYPES:
+        return sniffed or "application/octet-stream"
+    if sniffed and sniffed.split("/")[0] != declared.split("/")[0]:
+        metrics.incr("media.content_type_mismatch")
+    return declared
+
+async def _spool_media(response, path: str) -> Optional[tuple[int, bytes, str]]:
+    """
+    Streams a response body into `path` chunk by chunk, so at most one chunk per file is held
+    in memory. Returns the size, the first bytes and the SHA-256 of the body, or None when the
+    body exceeds MEDIA_MAX_BYTES.
+    """
+    size = 0
+    head = b""
+    peak = 0
+    digest = hashlib.sha256()
+    async with aiofiles.open(path, "wb") as file:
+        async for chunk in response.content.iter_chunked(MEDIA_CHUNK_SIZE):
+            size += len(chunk)
+            if size > MEDIA_MAX_BYTES:
+                return None
+            if len(head) < MAGIC_HEAD_SIZE:
+                head += chunk[:MAGIC_HEAD_SIZE - len(head)]
+            peak = max(peak, len(chunk))
+            digest.update(chunk)
+            await file.write(chunk)
+    metrics.observe("media.peak_buffer_bytes", peak)
+    return size, head, digest.hexdigest()
+
+async def fetch_and_upload_file(image_url: str, bucket_name: str, client, supabase_url, media_index=None) -> Optional[str]:
+    """
+    Relays a Twilio media file to Supabase storage. The download is spooled to a size capped
+    temporary file which the storage client uploads from disk, so memory use per file stays
+    constant whatever the file size.
+
+    Objects are named after the SHA-256 of their content. With a `media_index`
+    (MediaIndexManager) a file uploaded before is not uploaded again, its url is reused.
+
+    Returns None when the download or the upload fails.
+    """
+    session = http_sessions.get_session("media")
+    fd, path = tempfile.mkstemp(prefix="media-", dir=MEDIA_SPOOL_DIR)
+    os.close(fd)
+    try:
         # Fetch the file asynchronously
         async with session.get(image_url) as response:
-            if response.status == 200:
-                file_content = await response.read()
-                content_type = response.headers.get('Content-Type', 'application/octet-stream')
-            else:
-                async_logger.warn("Failed to fetch file from twilio, response: {response}")
+            if response.status != 200:
+                await async_logger.warning(f"Failed to fetch file from twilio, response: {response}")
+                return None
+            if response.content_length and response.content_length > MEDIA_MAX_BYTES:
+                metrics.incr("media.too_large")
+                await async_logger.warning(f"Media file of {response.content_length} bytes exceeds MEDIA_MAX_BYTES, skipping {image_url}")
+                return None
+
+            start = time.perf_counter()
+            spooled = await _spool_media(response, path)
+            if spooled is None:
+                metrics.incr("media.too_large")
+                await async_logger.warning(f"Media file exceeds MEDIA_MAX_BYTES while downloading, skipping {image_url}")
                 return None
+            size, head, sha256 = spooled
+            elapsed = time.perf_counter() - start
+            content_type = sniff_content_type(head, response.headers.get('Content-Type', 'application/octet-stream'))
 
-    # Use the mimetypes module to guess the extension based on the MIME type
-    guess_extension = mimetypes.guess_extension(content_type) or '.bin'
-    random_filename = f"{uuid.uuid4()}{guess_extension}"
+        metrics.observe("media.download_bytes", size)
+        metrics.observe("media.download_seconds", elapsed)
+        if elapsed > 0:
+            metrics.observe("media.download_bytes_per_second", size / elapsed)
 
-    # Upload the file to Supabase Storage with the random filename and MIME type
-    response = await client.storage.from_(bucket_name).upload(random_filename, file_content, file_options={"content-type": content_type})
-    print(f"Supabase Response: \n\n {response}")
-    if response.status_code in (200, 201):
-        url = f"{supabase_url}/storage/v1/object/public/{bucket_name}/{random_filename}"
-        return url
-    else:
-        async_logger.warn("Failed to upload file to supabase: resoonse: {response}")
+        if media_index is not None:
+            url = await media_index.get_url(sha256)
+            if url:
+                metrics.incr("media.dedupe_hits")
+                metrics.incr("media.dedupe_bytes_saved", size)
+                return url
+
+        # Use the mimetypes module to guess the extension based on the MIME type
+        guess_extension = mimetypes.guess_extension(content_type) or '.bin'
+        filename = f"{sha256}{guess_extension}"
 
-    return None
+        # Upload the file to Supabase Storage with the content addressed filename and MIME type, the client streams it from the path.
+        # Overwriting is harmless, an object with this name always has the same content.
+        start = time.perf_counter()
+        response = await client.storage.from_(bucket_name).upload(filename, path, file_options={"content-type": content_type, "x-upsert": "true"})
+        elapsed = time.perf_counter() - start
+        metrics.observe("media.upload_seconds", elapsed)
+        if elapsed > 0:
+            metrics.observe("media.upload_bytes_per_second", size / elapsed)
+        print(f"Supabase Response: \n\n {response}")
+        if response.status_code in (200, 201):
+            url = f"{supabase_url}/storage/v1/object/public/{bucket_name}/{filename}"
+            if media_index is not None:
+                await media_index.store(sha256, url, bucket_name, size, content_type)
+            return url
+        else:
+            await async_logger.warning(f"Failed to upload file to supabase: response: {response}")
+
+        return None
+    except (aiohttp.ClientError, asyncio.TimeoutError) as error:
+        await async_logger.warning(f"Failed to fetch file from twilio, {image_url}: {error!r}")
+        return None
+    except (StorageException, httpx.HTTPError) as error:
+        await async_logger.warning(f"Failed to upload file to supabase: {error!r}")
+        return None
+    finally:
+        await aiofiles.os.remove(path)
@@ -0,0 +1,48 @@
+import os
+from typing import Optional
+import aiohttp
+
+# Per-integration pool settings: (total connection limit, per host limit, total timeout, connect timeout)
+INTEGRATIONS = {
+    "creditspanama": (20, 10, float(os.environ.get('CREDITS_PANAMA_TIMEOUT', 15)), 5),
+    "b2chat": (20, 10, float(os.environ.get('B2CHAT_TIMEOUT', 15)), 5),
+    "twilio": (50, 25, float(os.environ.get('TWILIO_TIMEOUT', 15)), 5),
+    "media": (20, 10, float(os.environ.get('MEDIA_TIMEOUT', 60)), 10),
+}
+
+DNS_CACHE_TTL = int(os.environ.get('HTTP_DNS_CACHE_TTL', 300))
+KEEPALIVE_TIMEOUT = float(os.environ.get('HTTP_KEEPALIVE_TIMEOUT', 60))
+
+_sessions: dict[str, aiohttp.ClientSession] = {}
+
+async def init_sessions():
+    """Creates one long-lived, pooled ClientSession per integration. Called from the FastAPI lifespan."""
+    for name, (limit, limit_per_host, total_timeout, connect_timeout) in INTEGRATIONS.items():
+        connector = aiohttp.TCPConnector(
+            limit=limit,
+            limit_per_host=limit_per_host,
+            ttl_dns_cache=DNS_CACHE_TTL,
+            use_dns_cache=True,
+            keepalive_timeout=KEEPALIVE_TIMEOUT,
+        )
+        _sessions[name] = aiohttp.ClientSession(
+            connector=connector,
+            timeout=aiohttp.ClientTimeout(total=total_timeout, connect=connect_timeout),
+        )
+
+async def close_sessions():
+    for session in _sessions.values():
+        await session.close()
+    _sessions.clear()
+
+def get_session(name: str) -> aiohttp.ClientSession:
+    """
+    Returns the shared session for an integration.
+
+    :param name: One of the keys of INTEGRATIONS.
+    :return: The pooled ClientSession, never to be closed by the caller.
+    """
+    session: Optional[aiohttp.ClientSession] = _sessions.get(name)
+    if session is None or session.closed:
+        raise RuntimeError(f"HTTP session '{name}' is not initialised, init_sessions() must run in the lifespan")
+    return session
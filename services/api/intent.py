@@ -0,0 +1,87 @@
+import os
+import re
+import unicodedata
+from typing import Optional
+
+import metrics
+
+# Weighted cues, matched against the normalized message
+RESTART_CUES = [
+    (re.compile(r"\b(reinici\w*|reset\w*|restart\w*)\b"), 2.0),
+    (re.compile(r"\b(empezar|empecemos|empezamos|comenzar|comencemos|comenzamos|iniciar|volver a empezar)\b.*\b(de nuevo|otra vez|desde cero|nuevamente)\b"), 2.0),
+    (re.compile(r"\bvolver a (empezar|comenzar|iniciar)\b"), 2.0),
+    (re.compile(r"\b(borra\w*|elimina\w*|limpia\w*)\b.*\b(chat|conversacion)\b"), 2.5),
+    # "historial" and "mensajes" are just as often about the account, e.g. "historial de pagos"
+    (re.compile(r"\b(borra\w*|elimina\w*|limpia\w*)\b.*\b(historial|mensajes)\b"), 1.5),
+    (re.compile(r"\b(nuevo chat|nueva conversacion|desde cero)\b"), 1.5),
+]
+
+# Words that make a restart cue about the conversation itself
+CHAT_CONTEXT = re.compile(r"\b(chat|conversacion|bot|todo)\b")
+
+# Words that point at restarting something else, e.g. "como reinicio mi celular"
+OTHER_OBJECTS = re.compile(r"\b(telefono|celular|equipo|movil|aparato|clave|pin|codigo|contrasena|cuenta|prestamo|pago|plazo|bloque\w*)\b")
+
+# Credit and payment vocabulary, a restart cue next to it is never answered locally
+CREDIT_CONTEXT = re.compile(r"\b(credit\w*|pago\w*|pagar|deuda\w*|cuota\w*|prestamo\w*|saldo\w*|factura\w*|cobro\w*|abono\w*|mora)\b")
+
+# Negated, questioning or past-tense mentions, e.g. "no reinicies el chat" or "por que se reinicio el chat",
+# describe or refuse a restart rather than ask for one
+NOT_A_REQUEST = re.compile(
+    r"\b(no|nunca|jamas|tampoco|por que|porque|que paso"
+    r"|se (reinici|resete|borr|elimin|limpi)\w*"
+    r"|(reinici|resete|borr|elimin|limpi)(o|aste|aron)"
+    r"|(empez|comenz)(o|aste|aron))\b"
+)
+
+# Above the high threshold we answer Y, at or below zero N, anything in between goes to the LLM
+RESTART_SCORE_HIGH = float(os.environ.get('RESTART_SCORE_HIGH', 3.0))
+
+def normalize(text: str) -> str:
+    """Lowercases, strips accents and punctuation and collapses whitespace."""
+    text = unicodedata.normalize("NFKD", text.lower())
+    text = "".join(char for char in text if not unicodedata.combining(char))
+    text = re.sub(r"[^\w\s]", " ", text)
+    return re.sub(r"\s+", " ", text).strip()
+
+def restart_score(message: str) -> float:
+    """
+    Scores how likely the message asks to restart the chat. 0 means no restart cue at all.
+    Short messages and explicit mentions of the chat raise the score, mentions of a phone,
+    code or the account lower it.
+    """
+    text = normalize(message)
+    score = sum(weight for pattern, weight in RESTART_CUES if pattern.search(text))
+    if score == 0:
+        return 0.0
+
+    if CHAT_CONTEXT.search(text):
+        score += 1.0
+    if len(text.split()) <= 5:
+        score += 1.0
+    if OTHER_OBJECTS.search(text):
+        score -= 3.0
+    # Long messages usually ask something else and mention restarting in passing
+    if len(text.split()) > 20:
+        score -= 1.5
+
+    return max(score, 0.01)
+
+def detect_restart(message: str) -> Optional[str]:
+    """
+    Local fast path for the restart intent.
+
+    :return: "Y" or "N" when the decision is clear, None when the LLM should decide.
+        Messages with a restart cue that are about credit or payments, negated, questions
+        or in the past tense always go to the LLM.
+    """
+    score = restart_score(message)
+    if score == 0:
+        metrics.incr("intent.restart.local_no")
+        return "N"
+    text = normalize(message)
+    if score >= RESTART_SCORE_HIGH and not CREDIT_CONTEXT.search(text) and not NOT_A_REQUEST.search(text):
+        metrics.incr("intent.restart.local_yes")
+        return "Y"
+    metrics.incr("intent.restart.ambiguous")
+    return None
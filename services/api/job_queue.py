@@ -0,0 +1,300 @@
+import os
+import asyncio
+import traceback
+from datetime import datetime, timedelta
+from typing import Any, Awaitable, Callable, Optional
+
+from pymongo import ReturnDocument
+from pymongo.errors import DuplicateKeyError
+
+from mongo.db_ops import MongoDBManager
+from debounce import WORKER_ID
+import metrics
+from logger import async_logger
+
+JOB_WORKERS = int(os.environ.get('JOB_WORKERS', 16))
+JOB_VISIBILITY_TIMEOUT = float(os.environ.get('JOB_VISIBILITY_TIMEOUT', 300))
+JOB_MAX_ATTEMPTS = int(os.environ.get('JOB_MAX_ATTEMPTS', 5))
+JOB_RETRY_BACKOFF = float(os.environ.get('JOB_RETRY_BACKOFF', 5))
+JOB_POLL_INTERVAL = float(os.environ.get('JOB_POLL_INTERVAL', 1))
+# How many keys with claimable jobs a worker tries before going back to sleep
+JOB_CLAIM_SCAN = int(os.environ.get('JOB_CLAIM_SCAN', 20))
+
+class JobProgress:
+    """
+    Steps of a job that already ran, stored in the `steps` array of the job document so a
+    retry skips the side effects the earlier attempts completed, e.g. a message that was
+    already relayed. A step is recorded right after it ran; a worker dying in between still
+    repeats that one step.
+    """
+
+    def __init__(self, jobs, job: dict):
+        self.jobs = jobs
+        self.job_id = job["_id"]
+        self.steps = set(job.get("steps", []))
+
+    def done(self, step: str) -> bool:
+        return step in self.steps
+
+    async def once(self, step: str, action: Callable[[], Awaitable[Any]]) -> Any:
+        """Runs `action` unless `step` already ran in an earlier attempt, returns its result or None."""
+        if step in self.steps:
+            metrics.incr("jobs.steps_skipped")
+            return None
+        result = await action()
+        self.steps.add(step)
+        await self.jobs.update_one({"_id": self.job_id, "lease_owner": WORKER_ID}, {"$addToSet": {"steps": step}})
+        return result
+
+Handler = Callable[[dict, JobProgress], Awaitable[None]]
+
+class JobQueue:
+    """
+    Durable queue for webhook payloads in the `webhook-jobs` collection, so the webhooks
+    can persist the raw payload and answer right away.
+
+    Jobs with the same key (the sender or the B2Chat chat) run one at a time and in
+    arrival order: a worker has to take the key's lock in `webhook-job-locks` and then
+    always runs the oldest job of that key. Both the lock and the job carry a lease of
+    `visibility_timeout` seconds that is renewed while the job runs; when a worker dies
+    the lease expires and another worker picks the job up again.
+
+    One claim loop per process polls Mongo and hands the claimed jobs to the workers through
+    an asyncio.Queue, claiming only while a worker is free.
+
+    A failing job is retried with exponential backoff and moved to `webhook-jobs-dead`
+    after `max_attempts` attempts. Handlers get a JobProgress and run every step with a
+    side effect through it, so a retry does not repeat what an earlier attempt did.
+    """
+
+    def __init__(self, db: MongoDBManager, visibility_timeout: float = JOB_VISIBILITY_TIMEOUT,
+                 max_attempts: int = JOB_MAX_ATTEMPTS, retry_backoff: float = JOB_RETRY_BACKOFF,
+                 poll_interval: float = JOB_POLL_INTERVAL):
+        self.jobs = db.get_collection("webhook-jobs")
+        self.dead = db.get_collection("webhook-jobs-dead")
+        self.locks = db.get_collection("webhook-job-locks")
+        self.visibility_timeout = visibility_timeout
+        self.max_attempts = max_attempts
+        self.retry_backoff = retry_backoff
+        self.poll_interval = poll_interval
+        self.handlers: dict[str, Handler] = {}
+        self._workers: list[asyncio.Task] = []
+        self._claimer: Optional[asyncio.Task] = None
+        self._ready: asyncio.Queue = asyncio.Queue()
+        self._idle: Optional[asyncio.Semaphore] = None
+        self._wakeup = asyncio.Event()
+        self._stopping = False
+        self._busy = 0
+
+        metrics.register_gauge("jobs.busy_workers", lambda: self._busy)
+
+    async def ensure_indexes(self):
+        await self.jobs.create_index([("status", 1), ("available_at", 1)])
+        await self.jobs.create_index([("key", 1), ("created_at", 1)])
+        await self.dead.create_index([("failed_at", 1)])
+
+    async def enqueue(self, kind: str, key: str, payload: dict):
+        await self.enqueue_many(kind, [(key, payload)])
+
+    async def enqueue_many(self, kind: str, jobs: list[tuple[str, dict]]):
+        """Queues several (key, payload) jobs of one kind with a single insert."""
+        if not jobs:
+            return
+        now = datetime.utcnow()
+        await self.jobs.insert_many([
+            {
+                "kind": kind,
+                "key": key,
+                "payload": payload,
+                "status": "queued",
+                "attempts": 0,
+                "available_at": now,
+                "created_at": now,
+            }
+            for key, payload in jobs
+        ])
+        metrics.incr(f"jobs.{kind}.enqueued", len(jobs))
+        self._wakeup.set()
+
+    def start(self, handlers: dict[str, Handler], concurrency: int = JOB_WORKERS):
+        """Starts `concurrency` workers running the handler registered for each job kind, and the claim loop feeding them."""
+        self.handlers.update(handlers)
+        self._stopping = False
+        self._ready = asyncio.Queue()
+        self._idle = asyncio.Semaphore(concurrency)
+        self._workers = [asyncio.create_task(self._worker(), name=f"job-worker-{i}") for i in range(concurrency)]
+        self._claimer = asyncio.create_task(self._claim_loop(), name="job-claimer")
+
+    async def stop(self, timeout: float = 10):
+        """
+        Stops claiming and lets the claimed jobs finish for up to `timeout` seconds. Jobs
+        cancelled after that keep their lease and are picked up again once it expires.
+        """
+        self._stopping = True
+        self._wakeup.set()
+        if self._claimer is None:
+            return
+        deadline = asyncio.get_running_loop().time() + timeout
+
+        # The claim loop exits on its own once the claim in progress is handed over
+        _, pending = await asyncio.wait([self._claimer], timeout=timeout)
+        for task in pending:
+            task.cancel()
+        await asyncio.gather(*pending, return_exceptions=True)
+
+        # Workers drain the claimed jobs before reaching their None
+        for _ in self._workers:
+            self._ready.put_nowait(None)
+        remaining = max(deadline - asyncio.get_running_loop().time(), 0)
+        _, pending = await asyncio.wait(self._workers, timeout=remaining)
+        for task in pending:
+            task.cancel()
+        await asyncio.gather(*pending, return_exceptions=True)
+        self._workers = []
+        self._claimer = None
+
+    async def _claim_loop(self):
+        while not self._stopping:
+            await self._idle.acquire()
+            job = None
+            if not self._stopping:
+                try:
+                    job = await self._claim()
+                except Exception as error:
+                    await async_logger.error(f"job_queue claim failed: {error}")
+            if job is not None:
+                self._ready.put_nowait(job)
+                continue
+            self._idle.release()
+            if self._stopping:
+                return
+
+            try:
+                await asyncio.wait_for(self._wakeup.wait(), self.poll_interval)
+            except asyncio.TimeoutError:
+                pass
+            self._wakeup.clear()
+
+    async def _worker(self):
+        while True:
+            job = await self._ready.get()
+            if job is None:
+                return
+            try:
+                await self._run(job)
+            except Exception as error:
+                await async_logger.error(f"job_queue worker failed: {error}")
+            finally:
+                self._idle.release()
+
+    def _claimable(self, now: datetime) -> dict:
+        return {"$or": [
+            {"status": "queued", "available_at": {"$lte": now}},
+            # Left behind by a worker that died or got stuck
+            {"status": "running", "lease_expires": {"$lte": now}},
+        ]}
+
+    async def _claim(self) -> Optional[dict]:
+        now = datetime.utcnow()
+        # Keys with a running job are left out, so a long backlog of one key can't hide the others
+        locked = await self.locks.distinct("_id", {"expires": {"$gt": now}})
+        candidates = await self.jobs.aggregate([
+            {"$match": {**self._claimable(now), "key": {"$nin": locked}}},
+            {"$group": {"_id": "$key", "created_at": {"$min": "$created_at"}}},
+            {"$sort": {"created_at": 1}},
+            {"$limit": JOB_CLAIM_SCAN},
+        ]).to_list(length=JOB_CLAIM_SCAN)
+        for candidate in candidates:
+            key = candidate["_id"]
+            if not await self._lock(key, now):
+                continue
+
+            # Only the oldest job of a key may run, a newer one waits while an older one backs off
+            head = await self.jobs.find_one({"key": key}, sort=[("created_at", 1), ("_id", 1)])
+            job = None
+            if head is not None:
+                job = await self.jobs.find_one_and_update(
+                    {"_id": head["_id"], **self._claimable(now)},
+                    {
+                        "$set": {"status": "running", "lease_owner": WORKER_ID, "lease_expires": now + timedelta(seconds=self.visibility_timeout)},
+                        "$inc": {"attempts": 1},
+                    },
+                    return_document=ReturnDocument.AFTER,
+                )
+            if job is not None:
+                return job
+            await self._unlock(key)
+        return None
+
+    async def _lock(self, key: str, now: datetime) -> bool:
+        try:
+            await self.locks.update_one(
+                {"_id": key, "expires": {"$lte": now}},
+                {"$set": {"owner": WORKER_ID, "expires": now + timedelta(seconds=self.visibility_timeout)}},
+                upsert=True,
+            )
+            return True
+        except DuplicateKeyError:
+            # The lock document exists and has not expired, another job of the key is running
+            return False
+
+    async def _unlock(self, key: str):
+        await self.locks.delete_one({"_id": key, "owner": WORKER_ID})
+
+    async def _heartbeat(self, job: dict):
+        while True:
+            await asyncio.sleep(self.visibility_timeout / 3)
+            expires = datetime.utcnow() + timedelta(seconds=self.visibility_timeout)
+            await self.jobs.update_one({"_id": job["_id"], "lease_owner": WORKER_ID}, {"$set": {"lease_expires": expires}})
+            await self.locks.update_one({"_id": job["key"], "owner": WORKER_ID}, {"$set": {"expires": expires}})
+
+    async def _run(self, job: dict):
+        kind = job["kind"]
+        handler = self.handlers.get(kind)
+        self._busy += 1
+        heartbeat = asyncio.create_task(self._heartbeat(job))
+        try:
+            if handler is None:
+                await self._dead_letter(job, f"No handler registered for job kind {kind}")
+                return
+            if job["attempts"] > self.max_attempts:
+                # Every attempt so far ended with an expired lease instead of an error
+                await self._dead_letter(job, "Lease expired on every attempt")
+                return
+
+            metrics.observe(f"jobs.{kind}.queue_wait", (datetime.utcnow() - job["created_at"]).total_seconds())
+            try:
+                with metrics.timer(f"jobs.{kind}.run_time"):
+                    await handler(job["payload"], JobProgress(self.jobs, job))
+            except Exception as error:
+                await self._fail(job, error)
+            else:
+                await self.jobs.delete_one({"_id": job["_id"], "lease_owner": WORKER_ID})
+                metrics.incr(f"jobs.{kind}.completed")
+        finally:
+            heartbeat.cancel()
+            self._busy -= 1
+            await self._unlock(job["key"])
+
+    async def _fail(self, job: dict, error: Exception):
+        exc_traceback = ''.join(traceback.format_exception(type(error), error, error.__traceback__))
+        if job["attempts"] >= self.max_attempts:
+            await self._dead_letter(job, exc_traceback)
+            return
+
+        delay = self.retry_backoff * 2 ** (job["attempts"] - 1)
+        await self.jobs.update_one(
+            {"_id": job["_id"], "lease_owner": WORKER_ID},
+            {
+                "$set": {"status": "queued", "available_at": datetime.utcnow() + timedelta(seconds=delay), "last_error": exc_traceback},
+                "$unset": {"lease_owner": "", "lease_expires": ""},
+            },
+        )
+        metrics.incr(f"jobs.{job['kind']}.retried")
+        await async_logger.warning(f"Job {job['kind']} {job['_id']} failed on attempt {job['attempts']}/{self.max_attempts}, retrying in {delay}s: {error}")
+
+    async def _dead_letter(self, job: dict, error: str):
+        await self.dead.replace_one({"_id": job["_id"]}, {**job, "error": error, "failed_at": datetime.utcnow()}, upsert=True)
+        await self.jobs.delete_one({"_id": job["_id"]})
+        metrics.incr(f"jobs.{job['kind']}.dead")
+        await async_logger.error(f"Job {job['kind']} {job['_id']} moved to the dead-letter collection: {error}")
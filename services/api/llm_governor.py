@@ -0,0 +1,121 @@
+import os
+import re
+import time
+import heapq
+import asyncio
+import itertools
+from contextlib import asynccontextmanager
+from typing import Optional
+
+import metrics
+
+# Lower numbers are served first
+PRIORITY_CUSTOMER = 0
+PRIORITY_BACKGROUND = 10
+
+def _model_setting(model: str, setting: str, default: float) -> float:
+    """Reads LLM_<MODEL>_<SETTING>, falling back to LLM_<SETTING> and then to the default."""
+    model_key = re.sub(r"[^A-Z0-9]", "_", model.upper())
+    return float(os.environ.get(f"LLM_{model_key}_{setting}", os.environ.get(f"LLM_{setting}", default)))
+
+class TokenBucket:
+    """Refills `rate_per_minute` units per minute up to one minute worth of capacity."""
+
+    def __init__(self, rate_per_minute: float):
+        self.capacity = rate_per_minute
+        self.rate = rate_per_minute / 60
+        self.tokens = rate_per_minute
+        self.updated = time.monotonic()
+
+    def _refill(self):
+        now = time.monotonic()
+        self.tokens = min(self.capacity, self.tokens + (now - self.updated) * self.rate)
+        self.updated = now
+
+    def wait_time(self, amount: float) -> float:
+        """Seconds until `amount` units are available, 0 if they are available now."""
+        self._refill()
+        amount = min(amount, self.capacity)
+        return 0.0 if self.tokens >= amount else (amount - self.tokens) / self.rate
+
+    def take(self, amount: float):
+        self._refill()
+        self.tokens -= min(amount, self.capacity)
+
+class _ModelLane:
+    def __init__(self, model: str):
+        self.concurrency = int(_model_setting(model, "MAX_CONCURRENCY", 8))
+        self.requests = TokenBucket(_model_setting(model, "RPM", 500))
+        self.tokens = TokenBucket(_model_setting(model, "TPM", 300000))
+        self.inflight = 0
+        self.waiters: list[tuple[int, int, asyncio.Future, int]] = []
+        self.retry_handle: Optional[asyncio.TimerHandle] = None
+
+class LLMGovernor:
+    """
+    Admission control for every LLM call of the worker. Each model gets its own
+    concurrency limit and request/token per minute buckets; waiting calls are
+    admitted by priority, then in arrival order.
+    """
+
+    def __init__(self):
+        self._lanes: dict[str, _ModelLane] = {}
+        self._seq = itertools.count()
+
+    def _lane(self, model: str) -> _ModelLane:
+        lane = self._lanes.get(model)
+        if lane is None:
+            lane = self._lanes[model] = _ModelLane(model)
+            metrics.register_gauge(f"llm.{model}.queued", lambda: sum(1 for waiter in lane.waiters if not waiter[2].done()))
+            metrics.register_gauge(f"llm.{model}.inflight", lambda: lane.inflight)
+        return lane
+
+    @asynccontextmanager
+    async def slot(self, model: str, estimated_tokens: int, priority: int = PRIORITY_CUSTOMER):
+        """Waits until a call to `model` with about `estimated_tokens` tokens may start."""
+        lane = self._lane(model)
+        future = asyncio.get_running_loop().create_future()
+        heapq.heappush(lane.waiters, (priority, next(self._seq), future, estimated_tokens))
+        queued_at = time.monotonic()
+        self._dispatch(lane)
+
+        try:
+            await future
+        except asyncio.CancelledError:
+            # Cancelled right after being admitted, give the slot back
+            if future.done() and not future.cancelled():
+                self._release(lane)
+            raise
+
+        metrics.observe(f"llm.{model}.queue_wait", time.monotonic() - queued_at)
+        try:
+            yield
+        finally:
+            self._release(lane)
+
+    def _release(self, lane: _ModelLane):
+        lane.inflight -= 1
+        self._dispatch(lane)
+
+    def _dispatch(self, lane: _ModelLane, from_timer: bool = False):
+        if from_timer:
+            lane.retry_handle = None
+        while lane.waiters and lane.inflight < lane.concurrency:
+            _, _, future, estimated_tokens = lane.waiters[0]
+            if future.done():
+                heapq.heappop(lane.waiters)
+                continue
+
+            wait = max(lane.requests.wait_time(1), lane.tokens.wait_time(estimated_tokens))
+            if wait > 0:
+                if lane.retry_handle is None:
+                    lane.retry_handle = asyncio.get_running_loop().call_later(wait, self._dispatch, lane, True)
+                return
+
+            heapq.heappop(lane.waiters)
+            lane.requests.take(1)
+            lane.tokens.take(estimated_tokens)
+            lane.inflight += 1
+            future.set_result(None)
+
+governor = LLMGovernor()
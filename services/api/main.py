@@ -1,24 +1,35 @@
 import os
+import secrets
 import uvicorn
 from contextlib import asynccontextmanager
-from fastapi import Depends, FastAPI, Request
+from fastapi import Depends, FastAPI, HTTPException, Request
 from fastapi.responses import JSONResponse
 from twilio.request_validator import RequestValidator
 from pydantic import BaseModel
-from typing import Optional
+from typing import Any, Awaitable, Callable, Optional
 import traceback
 import asyncio
 import json
-from fastapi.security import HTTPBasic
+import time
+from fastapi.security import HTTPBasic, HTTPBasicCredentials
 from supabase_py_async import AsyncClient, create_client
 from supabase_py_async.lib.client_options import ClientOptions
 
-from mongo.db_ops import AsyncMongoMemoryManager, MessageType, MongoDBManager, SessionManager, ChatManager, SwitchManager, AnalyticsManager
+from mongo.db_ops import AsyncMongoMemoryManager, MessageType, MongoDBManager, SessionManager, ChatManager, SwitchManager, AnalyticsManager, Managers
 
 import b2chat
 import twilio_messaging
 import chains
 import helpers
+import http_sessions
+import background
+import debounce
+import metrics
+import summarizer
+import intent
+import response_cache
+import job_queue
+import dedupe
 from logger import async_logger, shutdown_logger
 
 
@@ -28,24 +39,55 @@ AUTH_TOKEN = os.environ['TWILIO_AUTH_TOKEN']
 MONGO_CONNECTION_STRING = os.environ['MONGO_CONNECTION_STRING']
 DB = MongoDBManager(MONGO_CONNECTION_STRING, "CreditsPanama")
 API_KEY_CREDITS_PANAMA = os.getenv("API_KEY_CREDITS_PANAMA", "error")
+STREAM_RESPONSES = os.getenv("STREAM_RESPONSES", "1") == "1"
+# /metrics answers 401 until both are set
+METRICS_USER = os.getenv("METRICS_USER", "")
+METRICS_PASS = os.getenv("METRICS_PASS", "")
 
 SUPABASE_URL = os.environ['SUPABASE_URL']
 SUPABASE_KEY = os.environ['SUPABASE_KEY']
 
 supabase_client: AsyncClient | None = None
+managers: Managers | None = None
+debounce_backend = None
+debounce_scheduler: debounce.DebounceScheduler | None = None
+webhook_queue: job_queue.JobQueue | None = None
+webhook_dedupe: dedupe.Deduplicator | None = None
 
 @asynccontextmanager
 async def lifespan(app: FastAPI):
+    global debounce_scheduler
+    scheduler_task = None
+    sweeper = None
     try:
         await init_supabase()
+        await init_mongo()
+        chains.init_chains()
+        await managers.response_cache.purge_other_versions(chains.prompt_version("dni_conversation"))
+        await http_sessions.init_sessions()
+        await twilio_messaging.start_sender()
+        debounce_scheduler = debounce.DebounceScheduler(process_and_respond)
+        scheduler_task = asyncio.create_task(debounce_scheduler.run())
+        sweeper = asyncio.create_task(debounce.run_sweeper(debounce_backend, debounce_scheduler))
+        webhook_queue.start({"twilio": process_client_webhook, "b2chat": process_agent_webhook})
         yield
     finally:
+        if webhook_queue is not None:
+            await webhook_queue.stop()
+        for task in (sweeper, scheduler_task):
+            if task is not None:
+                task.cancel()
+        # Turns still in flight send their answers, so the sender has to outlive them
+        await background.shutdown()
+        await twilio_messaging.stop_sender()
+        await b2chat.token_manager.close()
+        if managers is not None:
+            await asyncio.gather(managers.memory.close(), managers.analytics.close(), return_exceptions=True)
+        await http_sessions.close_sessions()
         await shutdown_logger()
 
 security = HTTPBasic()
 app = FastAPI(lifespan=lifespan)
-conversations = {}
-conversations_lock = asyncio.Lock()  # Initialize the lock
 
 class Message(BaseModel):
     message: str
@@ -74,95 +116,135 @@ async def init_supabase():
             options=ClientOptions(postgrest_client_timeout=10, storage_client_timeout=10)
     )
 
-async def get_session_manager():
-    session_manager = SessionManager(DB)
-    await session_manager.ensure_unique_session_index()
+async def init_mongo():
+    global managers, debounce_backend, webhook_queue, webhook_dedupe
+    managers = Managers(DB)
+    await managers.bootstrap()
+    webhook_queue = job_queue.JobQueue(DB)
+    await webhook_queue.ensure_indexes()
+    webhook_dedupe = dedupe.Deduplicator(DB)
+    await webhook_dedupe.ensure_indexes()
+    debounce_backend = debounce.create_backend(DB)
+    if isinstance(debounce_backend, debounce.MongoDebounceBackend):
+        await debounce_backend.ensure_indexes()
 
-    return SessionManager(DB)
+async def get_session_manager() -> SessionManager:
+    return managers.session
 
-async def get_chat_manager():
-    chat_manager = ChatManager(DB)
-    await chat_manager.ensure_unique_indexes()
-    return chat_manager
+async def get_chat_manager() -> ChatManager:
+    return managers.chat
 
-async def get_switch_manager():
-    return SwitchManager(DB)
+async def get_switch_manager() -> SwitchManager:
+    return managers.switch
 
-async def get_analytics_manager():
-    return AnalyticsManager(DB)
+async def get_analytics_manager() -> AnalyticsManager:
+    return managers.analytics
 
-async def get_mongo_manager():
-    return AsyncMongoMemoryManager(DB)
+async def get_mongo_manager() -> AsyncMongoMemoryManager:
+    return managers.memory
 
 @app.get("/ping")
 async def ping() -> str:
     return "pong"
 
+def check_metrics_credentials(credentials: HTTPBasicCredentials = Depends(security)):
+    valid_user = secrets.compare_digest(credentials.username.encode(), METRICS_USER.encode())
+    valid_pass = secrets.compare_digest(credentials.password.encode(), METRICS_PASS.encode())
+    if not (METRICS_USER and METRICS_PASS and valid_user and valid_pass):
+        raise HTTPException(status_code=401, detail="Invalid credentials", headers={"WWW-Authenticate": "Basic"})
+
+@app.get("/metrics", dependencies=[Depends(check_metrics_credentials)])
+async def get_metrics() -> dict:
+    return metrics.snapshot()
+
 @app.post("/b0cef29f-ec80-47ad-a5d3-80a8b8616a80")
 async def handle_incoming_message_agent(request: Request) -> str:
+    json_data = await request.json()
+    if not isinstance(json_data, dict):
+        await async_logger.warning(f"Unexpected B2Chat payload: {json_data}")
+        return "Ok"
+
+    # Drop the messages and events B2Chat already delivered before
+    items = [
+        (kind, item) for kind, required in (('messages', 'text'), ('events', 'type'))
+        for item in json_data.get(kind) or []
+        if isinstance(item, dict) and required in item and isinstance(item.get('chat'), dict) and 'chat_id' in item['chat']
+    ]
+    keys = [dedupe.b2chat_item_key(kind, item) for kind, item in items]
+    fresh = await webhook_dedupe.first_deliveries(keys)
+
+    # One job per chat: chats run concurrently, the messages and events of a chat in order
+    lanes: dict[str, dict] = {}
+    queued = set()
+    for (kind, item), key in zip(items, keys):
+        if key in fresh and key not in queued:
+            queued.add(key)
+            chat_id = item['chat']['chat_id']
+            lane = lanes.setdefault(str(chat_id), {'chat_id': chat_id, 'messages': [], 'events': []})
+            lane[kind].append(item)
+
+    try:
+        await webhook_queue.enqueue_many("b2chat", [(f"b2chat:{chat_id}", lane) for chat_id, lane in lanes.items()])
+    except Exception:
+        await webhook_dedupe.forget(list(fresh))
+        raise
+    return "Ok"
+
+async def process_agent_webhook(lane: dict, progress: job_queue.JobProgress):
+    """
+    Job handler of the B2Chat webhook: relays the agent messages of one chat to the client and
+    handles its events. Every relay is a step of the job, a retry only sends what is left.
+    """
     chat_manager = await get_chat_manager()
     session_manager = await get_session_manager()
-    json_data = await request.json()
     memory_manager = await get_mongo_manager()
 
-    
-    for message in json_data.get('messages', []):
-        if 'text' in message and 'chat' in message and 'chat_id' in message['chat']:
-            message_text = message['text']
-            chat_id = message['chat']['chat_id']
+    chat_id = lane['chat_id']
+    chat = await chat_manager.get_chat_contact(chat_id) or {}
+    conversation_number = chat.get('conversation_number')
+    phone_number = chat.get('phone_number')
 
-            conversation_number = await chat_manager.get_conversation_number(chat_id)
-            phone_number = await chat_manager.get_phone_number(chat_id)
+    async def relay(step: str, text: str):
+        # Both go out together, the next message of the chat waits for both
+        await progress.once(step, lambda: asyncio.gather(
+            memory_manager.add_message_permament(text, conversation_number, MessageType.B2CHAT_AGENT, phone_number),
+            twilio_messaging.send_answer_to_client(text, conversation_number),
+        ))
 
+    for index, message in enumerate(lane['messages']):
+        if conversation_number:
+            await relay(f"message:{index}", message['text'])
+
+    for index, event in enumerate(lane['events']):
+        event_type = event['type']
+        step = f"event:{index}"
+
+        if event_type == 'CLOSED_CHAT':
+            if conversation_number:
+                await relay(step, "El agente ha cerrado el chat.")
+                await session_manager.clear_unprocessed_media_urls(conversation_number)
+            await chat_manager.set_direct_to_agent_false(chat_id)
+        elif event_type == 'ASSIGNED_AGENT':
+            if conversation_number:
+                await relay(step, "El agente ha abierto el chat, ahora estás hablando con un agente.")
+            await chat_manager.set_direct_to_agent_false(chat_id)
+        elif event_type == 'AGENT_STARTED_CHAT':
             if conversation_number:
-                await memory_manager.add_message_permament(message_text, conversation_number, MessageType.B2CHAT_AGENT, phone_number)
-                twilio_messaging.send_answer_to_client(message_text, conversation_number)
-
-    for event in json_data.get('events', []):
-        if 'type' in event and 'chat' in event and 'chat_id' in event['chat']:
-            event_type = event['type']
-            chat_id = event['chat']['chat_id']
-            conversation_number = await chat_manager.get_conversation_number(chat_id)
-            phone_number = await chat_manager.get_phone_number(chat_id)
-
-            if event_type == 'CLOSED_CHAT':
-                if conversation_number:
-                    twilio_messaging.send_answer_to_client("El agente ha cerrado el chat.", conversation_number)
-                    await memory_manager.add_message_permament("El agente ha cerrado el chat.", conversation_number, MessageType.B2CHAT_AGENT, phone_number)
-                    await session_manager.clear_unprocessed_media_urls(conversation_number)
-                await chat_manager.set_direct_to_agent_false(chat_id)
-            elif event_type == 'ASSIGNED_AGENT':
-                if conversation_number:
-                    await memory_manager.add_message_permament("El agente ha abierto el chat, ahora estás hablando con un agente.", conversation_number, MessageType.B2CHAT_AGENT, phone_number)
-                    twilio_messaging.send_answer_to_client("El agente ha abierto el chat, ahora estás hablando con un agente.", conversation_number)
-                await chat_manager.set_direct_to_agent_false(chat_id)
-            elif event_type == 'AGENT_STARTED_CHAT':
-                if conversation_number:
-                    await memory_manager.add_message_permament("El agente ha abierto el chat, ahora estás hablando con un agente.", conversation_number, MessageType.B2CHAT_AGENT, phone_number)
-                    twilio_messaging.send_answer_to_client("El agente ha abierto el chat, ahora estás hablando con un agente.", conversation_number)
-                await chat_manager.set_direct_to_agent_false(chat_id)
-            elif event_type == 'AGENT_UNAVAILABLE':
-                await async_logger.warn("Problem B2Chat AGENT_UNAVAILABLE")
-                if conversation_number:
-                    await memory_manager.add_message_permament("Los agentes están actualmente no disponibles, nos pondremos en contacto contigo tan pronto como uno esté disponible.", conversation_number, MessageType.B2CHAT_AGENT, phone_number)
-                    twilio_messaging.send_answer_to_client("Los agentes están actualmente no disponibles, nos pondremos en contacto contigo tan pronto como uno esté disponible.", conversation_number)
-                await chat_manager.set_direct_to_agent_false(chat_id)
-            elif event_type == 'CHAT_UNAVAILABLE':
-                await async_logger.warn("Problem B2Chat CHAT_UNAVAILABLE")
-                if conversation_number:
-                    await memory_manager.add_message_permament("Hay un problema con la plataforma que están utilizando los agentes, actualmente no están disponibles.", conversation_number, MessageType.B2CHAT_AGENT, phone_number)
-                    twilio_messaging.send_answer_to_client("Hay un problema con la plataforma que están utilizando los agentes, actualmente no están disponibles.", conversation_number)
-                await chat_manager.set_direct_to_agent_false(chat_id)
-
-    return str("Ok")
+                await relay(step, "El agente ha abierto el chat, ahora estás hablando con un agente.")
+            await chat_manager.set_direct_to_agent_false(chat_id)
+        elif event_type == 'AGENT_UNAVAILABLE':
+            await async_logger.warn("Problem B2Chat AGENT_UNAVAILABLE")
+            if conversation_number:
+                await relay(step, "Los agentes están actualmente no disponibles, nos pondremos en contacto contigo tan pronto como uno esté disponible.")
+            await chat_manager.set_direct_to_agent_false(chat_id)
+        elif event_type == 'CHAT_UNAVAILABLE':
+            await async_logger.warn("Problem B2Chat CHAT_UNAVAILABLE")
+            if conversation_number:
+                await relay(step, "Hay un problema con la plataforma que están utilizando los agentes, actualmente no están disponibles.")
+            await chat_manager.set_direct_to_agent_false(chat_id)
 
 @app.post("/e510fa23-138a-457f-9577-69b58aa1b24b")
-async def handle_incoming_message_client(
-        request: Request,
-        session_manager = Depends(get_session_manager),
-        chat_manager = Depends(get_chat_manager),
-        switch_manager = Depends(get_switch_manager),
-    ) -> str:
+async def handle_incoming_message_client(request: Request) -> str:
     form_data = await request.form()
     data_dict = dict(form_data)
 
@@ -173,6 +255,29 @@ async def handle_incoming_message_client(
         await async_logger.warning(f"Hacking Attempt with request: {request}")
         return "Ok" 
 
+    # Twilio redelivers the webhook when we answer too slowly, only the first delivery is processed
+    dedupe_key = f"twilio:{data_dict['MessageSid']}" if data_dict.get('MessageSid') else None
+    if dedupe_key and not await webhook_dedupe.first_delivery(dedupe_key):
+        return "Ok"
+
+    # Messages of one sender are processed one at a time, in the order Twilio delivered them
+    try:
+        await webhook_queue.enqueue("twilio", data_dict.get('Author') or data_dict['ConversationSid'], data_dict)
+    except Exception:
+        if dedupe_key:
+            await webhook_dedupe.forget([dedupe_key])
+        raise
+    return "Ok"
+
+async def process_client_webhook(data_dict: dict, progress: job_queue.JobProgress):
+    """
+    Job handler of the Twilio webhook, runs the client message flows for one delivery. Handovers,
+    posts to the agent and answers to the client are steps of the job, a retry skips the ones done.
+    """
+    session_manager = await get_session_manager()
+    chat_manager = await get_chat_manager()
+    switch_manager = await get_switch_manager()
+
     chat_id = await chat_manager.get_chat_id(data_dict['ConversationSid'])
     if chat_id:
         await chat_manager.update_conversation_by_phone(data_dict['ConversationSid'], data_dict['Author'])
@@ -184,60 +289,63 @@ async def handle_incoming_message_client(
         media_urls = await session_manager.get_unprocessed_media_urls(data_dict['ConversationSid'])
 
         if dni is not None and len(media_urls) > 0:
-            await b2chat.agent_handover(chat_manager, dni, data_dict['ConversationSid'], "Client has sent an image", data_dict['Author'])
-            await session_manager.insert_or_update_session_dni(data_dict['ConversationSid'], dni)
-            id = await chat_manager.get_chat_id(data_dict['ConversationSid'])
-
-            for media_entry in media_urls:
-                url = media_entry['url']
-                media_type = media_entry['type']
-                if media_type == "IMAGE":
-                    await b2chat.post_image_to_agent(chat_manager, url, id, supabase_client, SUPABASE_URL)
-                    await memory.add_message_permament(url, data_dict['ConversationSid'], MessageType.B2CHAT_CLIENT, data_dict['Author'])
-
-                else:
-                    await b2chat.post_file_to_agent(chat_manager, url, id, supabase_client, SUPABASE_URL)
-                    await memory.add_message_permament(url, data_dict['ConversationSid'], MessageType.B2CHAT_CLIENT, data_dict['Author'])
-            
-            await memory.add_message_permament(data_dict['Body'], data_dict['ConversationSid'], MessageType.B2CHAT_CLIENT, data_dict['Author'])
-            await b2chat.post_message_to_agent(chat_manager, data_dict['Body'], id)
+            # The uploads run while the agent chat is being opened
+            uploads = [
+                (f"media:{index}", media_entry['type'], asyncio.create_task(upload_media(media_entry['url'], media_entry['type'])))
+                for index, media_entry in enumerate(media_urls) if not progress.done(f"media:{index}")
+            ]
+            try:
+                await progress.once("handover", lambda: b2chat.agent_handover(chat_manager, dni, data_dict['ConversationSid'], "Client has sent an image", data_dict['Author']))
+                await session_manager.insert_or_update_session_dni(data_dict['ConversationSid'], dni)
+                id = await chat_manager.get_chat_id(data_dict['ConversationSid'])
+                await relay_media_to_agent(id, uploads, data_dict['ConversationSid'], data_dict['Author'], progress)
+            finally:
+                cancel_uploads(uploads)
+
+            async def forward_message():
+                await memory.add_message_permament(data_dict['Body'], data_dict['ConversationSid'], MessageType.B2CHAT_CLIENT, data_dict['Author'])
+                await b2chat.post_message_to_agent(chat_manager, data_dict['Body'], id)
+            await progress.once("agent-message", forward_message)
 
             ret_msg = "Un agente se pondrá en contacto contigo pronto."
-            twilio_messaging.send_answer_to_client(ret_msg, data_dict['ConversationSid'])
-            await session_manager.clear_unprocessed_media_urls()
-            return "Ok"
+            await progress.once("reply", lambda: twilio_messaging.send_answer_to_client(ret_msg, data_dict['ConversationSid']))
+            await session_manager.clear_unprocessed_media_urls(data_dict['ConversationSid'])
+            return
 
     if 'Media' in data_dict and data_dict['Media']:
         session_manager = await get_session_manager()
         dni = await session_manager.get_session_dni(data_dict['ConversationSid'])
         if dni:
-            await media_flow(data_dict, dni)
+            await media_flow(data_dict, dni, progress)
         else:
-            async with conversations_lock:
-                if conversations.get(data_dict['Author'], {}).get('timer_task') is not None:
-                    conversations[data_dict['Author']]['timer_task'].cancel()
-                    del conversations[data_dict['Author']]
+            debounce_scheduler.cancel(data_dict['Author'])
+            await debounce_backend.discard(data_dict['Author'])
 
             media_type = ""
             media_items = json.loads(data_dict['Media'])
-            for media in media_items:
+            for index, media in enumerate(media_items):
                 content_type = media.get("ContentType")
                 if content_type and content_type.startswith("image/"):
                     media_type = "IMAGE"
                 else:
                     media_type = "FILE"
 
-                media = await twilio_messaging.fetch_media_by_sid(media['Sid'], data_dict['ChatServiceSid'])
-                media = json.loads(media)
-                url = media['links']['content_direct_temporary']
-                await session_manager.add_unprocessed_media_url(data_dict['ConversationSid'], url, media_type)
+                async def store_media_url(media=media, media_type=media_type):
+                    media = await twilio_messaging.fetch_media_by_sid(media['Sid'], data_dict['ChatServiceSid'])
+                    media = json.loads(media)
+                    url = media['links']['content_direct_temporary']
+                    await session_manager.add_unprocessed_media_url(data_dict['ConversationSid'], url, media_type)
+                await progress.once(f"pending-media:{index}", store_media_url)
 
             ret_msg = "Antes de poder enviar una imagen o archivo al agente, por favor ingresa tu número de cédula. Con \"-\" en el formato X-XXX-XXXX."
             memory = await get_mongo_manager()
-            await memory.add_message_memory(f"{media_type}_MESSAGE", data_dict['ConversationSid'], MessageType.HUMAN, data_dict['Author'])
-            await memory.add_message_memory(ret_msg, data_dict['ConversationSid'], MessageType.AI, data_dict['Author'])
-            twilio_messaging.send_answer_to_client(ret_msg, data_dict['ConversationSid'])
-        return "Ok"
+
+            async def ask_for_dni():
+                await memory.add_message_memory(f"{media_type}_MESSAGE", data_dict['ConversationSid'], MessageType.HUMAN, data_dict['Author'])
+                await memory.add_message_memory(ret_msg, data_dict['ConversationSid'], MessageType.AI, data_dict['Author'])
+                await twilio_messaging.send_answer_to_client(ret_msg, data_dict['ConversationSid'])
+            await progress.once("reply", ask_for_dni)
+        return
 
 
     message = Message(message=data_dict['Body'], author=data_dict['Author'], conversation=data_dict['ConversationSid'])
@@ -246,62 +354,51 @@ async def handle_incoming_message_client(
     if id:
         direct_to_agent = await chat_manager.get_direct_to_agent(id)
         if direct_to_agent:
-            await memory.add_message_permament(message.message, message.conversation, MessageType.B2CHAT_CLIENT, message.author)
-            await b2chat.post_message_to_agent(chat_manager, message.message, id)
-            return "Ok"
+            async def forward_message():
+                await memory.add_message_permament(message.message, message.conversation, MessageType.B2CHAT_CLIENT, message.author)
+                await b2chat.post_message_to_agent(chat_manager, message.message, id)
+            await progress.once("agent-message", forward_message)
+            return
 
     bot_on = await switch_manager.check_off_switch()
 
     if not bot_on:
-         await b2chat.agent_handover(chat_manager, "Bot off", message.conversation, "off-switch-triggered", message.author)
+         await progress.once("handover", lambda: b2chat.agent_handover(chat_manager, "Bot off", message.conversation, "off-switch-triggered", message.author))
          id = await chat_manager.get_chat_id(message.conversation)
-         await memory.add_message_permament(message.message, message.conversation, MessageType.B2CHAT_CLIENT, message.author)
-         await b2chat.post_message_to_agent(chat_manager, message.message, id)
-         return "Ok"
 
-    sender_id = data_dict['Author']
-    async with conversations_lock:
-        # Check if the sender already has a conversation
-        if sender_id not in conversations:
-            # If not, initialize their conversation and timer
-            conversations[sender_id] = {'messages': [message], 'timer_task': None}
-        else:
-            # If yes, append the message to their existing conversation
-            conversations[sender_id]['messages'].append(message)
-        
-        # Manage the timer
-        if conversations[sender_id]['timer_task'] is not None:
-            # If there's an existing timer, cancel it
-            conversations[sender_id]['timer_task'].cancel()
-        
-        # Always start a new timer task for the latest message
-        conversations[sender_id]['timer_task'] = asyncio.create_task(start_timer(sender_id, 16))
+         async def forward_message():
+             await memory.add_message_permament(message.message, message.conversation, MessageType.B2CHAT_CLIENT, message.author)
+             await b2chat.post_message_to_agent(chat_manager, message.message, id)
+         await progress.once("agent-message", forward_message)
+         return
 
-    return "Ok"
-
-
-async def start_timer(sender_id, duration):
-    print("start_timer() hit")
-    await asyncio.sleep(duration)
-    print("sleep over")
-    await process_and_respond(sender_id)
+    sender_id = data_dict['Author']
+    # Buffer the message, the deadline moves back with every new message of the sender
+    deadline = await progress.once("buffer", lambda: debounce_backend.append(sender_id, message.dict()))
+    if deadline is not None:
+        debounce_scheduler.schedule(sender_id, deadline)
 
 
 async def process_and_respond(sender_id: str):
     """
     Process the buffered messages for a given sender_id and respond.
-    This function simulates processing and must be replaced with actual logic.
+    Only the worker that claims the due buffer from the debounce backend responds.
     """
     print("process_and respond()")
-    async with conversations_lock:
-        if sender_id not in conversations:
-            print("Sender ID not in conversations, returning early.")
-            return
-        # Clone the necessary data while inside the lock
-        messages = conversations[sender_id]['messages'].copy()
-        del conversations[sender_id]  # Clear the conversation once cloned
+    buffered = await debounce_backend.claim(sender_id)
+    if not buffered:
+        print("Sender ID has no due messages or another worker owns them, returning early.")
+        return
+
+    try:
+        await respond_to_buffered(sender_id, [Message(**item) for item in buffered])
+    finally:
+        # Messages that arrived during the flush get their own turn
+        deadline = await debounce_backend.complete(sender_id, buffered)
+        if deadline is not None:
+            debounce_scheduler.schedule(sender_id, deadline)
 
-    # Now that we're outside the lock, we can perform the longer operations
+async def respond_to_buffered(sender_id: str, messages: list[Message]):
     print("Processing and responding...")
     combined_message = " ".join([msg.message for msg in messages])
     messages[0].message = combined_message  # Assuming modification of the first message for demonstration
@@ -323,50 +420,109 @@ async def process_and_respond(sender_id: str):
 
     ret = await execute_message(messages[0])
     print(f"Responding to {sender_id} with messages: {messages[0]}")
-    twilio_messaging.send_answer_to_client(ret, messages[0].conversation)
+    if ret is not None:
+        await twilio_messaging.send_answer_to_client(ret, messages[0].conversation)
+
+async def timed_stage(name: str, awaitable):
+    with metrics.timer(f"turn.{name}"):
+        return await awaitable
+
+async def detect_restart_intent(text: str) -> str:
+    # Only ask the LLM when the local detector can't tell
+    intent_restart = intent.detect_restart(text)
+    if intent_restart is None:
+        intent_restart = await chains.indicate_intent_restart(text)
+    return intent_restart
+
+async def prefetch_user_context(dni_task: asyncio.Task, text: str) -> Optional[dict]:
+    """Starts the user context lookup as soon as the DNI is known, from the session or from the message."""
+    dni_number = await asyncio.shield(dni_task) or helpers.find_dni(text)
+    if dni_number is None:
+        return None
+    return await timed_stage("user_context", helpers.get_user_context(dni_number, API_KEY_CREDITS_PANAMA))
 
 async def execute_message(
         message: Message,
-    ) -> str:
+    ) -> Optional[str]:
+    """
+    Runs one bot turn. Restart detection, memory loading, the session DNI lookup and the
+    user context prefetch run concurrently; the speculative work is cancelled if the user
+    asked for a restart. Analytics and the memory write of the client message are kept
+    off the critical path.
+
+    Returns the answer for the client, or None when it was already sent while streaming.
+    """
     print("execute_message()")
+    turn_start = time.perf_counter()
     chat_manager = await get_chat_manager()
     session_manager = await get_session_manager()
     analytics_manager = await get_analytics_manager()
     mongo_memory_manager = await get_mongo_manager()
 
-    await analytics_manager.increment_count_month()
+    analytics_manager.increment("messages")
+
+    restart_task = asyncio.create_task(timed_stage("restart_intent", detect_restart_intent(message.message)))
+    memory_task = asyncio.create_task(timed_stage("load_buffer", mongo_memory_manager.load_buffer(message.conversation)))
+    dni_task = asyncio.create_task(timed_stage("session_dni", session_manager.get_session_dni(message.conversation)))
+    context_task = asyncio.create_task(prefetch_user_context(dni_task, message.message))
 
-    intent_restart = await chains.indicate_intent_restart(message.message)
+    try:
+        intent_restart = await restart_task
+    except BaseException:
+        for task in (memory_task, dni_task, context_task):
+            task.cancel()
+        raise
 
     if intent_restart == "Y" or intent_restart == "y":
+        memory_task.cancel()
+        context_task.cancel()
         await mongo_memory_manager.clear(message.conversation)
         await mongo_memory_manager.add_message_permament(message.message, message.conversation, MessageType.HUMAN, message.author) 
         await mongo_memory_manager.add_message_permament("El chat ha sido reiniciado.", message.conversation, MessageType.AI, message.author) 
+        helpers.invalidate_user_context(await dni_task)
         await session_manager.delete_session_by_id(message.conversation)
         return "El chat ha sido reiniciado."
 
-    memory = await mongo_memory_manager.load_buffer(message.conversation)
+    try:
+        memory, session_dni = await asyncio.gather(memory_task, dni_task)
+    except BaseException:
+        # gather leaves the other task running and nothing would await the prefetch
+        for task in (memory_task, dni_task, context_task):
+            task.cancel()
+        raise
     print(memory)
 
-    await mongo_memory_manager.add_message_memory(message.message, message.conversation, MessageType.HUMAN, message.author)
+    background.spawn(mongo_memory_manager.add_message_memory(message.message, message.conversation, MessageType.HUMAN, message.author), name="add-message-memory")
 
-    message.dni_number = await session_manager.get_session_dni(message.conversation)
+    message.dni_number = session_dni or helpers.find_dni(message.message)
     ret = " "
     if message.dni_number is None:
-        message.dni_number = helpers.find_dni(message.message)
-        if message.dni_number is None:
-            ret = await chains.get_dni_conv_chain(message.message, memory)
+        context_task.cancel()
+        ret = await timed_stage("llm", response_cache.get_dni_conv_answer(managers.response_cache, message.message, memory))
+    else:
+        if session_dni is None:
+            try:
+                await session_manager.insert_or_update_session_dni(message.conversation, message.dni_number)
+            except BaseException:
+                context_task.cancel()
+                raise
+        user_context = await context_task
+
+        if 'msg' in user_context:
+            await session_manager.delete_session_by_id(message.conversation)
+            if 'msg-agent' in user_context:
+                await b2chat.agent_handover(chat_manager, message.dni_number, message.conversation, user_context['msg-agent'], message.author)
+            return user_context['msg']
+
+        if STREAM_RESPONSES:
+            sent = await timed_stage("llm", stream_support_answer(message, memory, user_context, chat_manager, turn_start))
+            if sent:
+                background.spawn(mongo_memory_manager.add_message_memory("\n".join(sent), message.conversation, MessageType.AI, message.author), name="add-message-memory")
+                summarizer.schedule_summary(mongo_memory_manager, message.conversation)
+                metrics.observe("turn.total", time.perf_counter() - turn_start)
+                return None
         else:
-            await session_manager.insert_or_update_session_dni(message.conversation, message.dni_number)
-            user_context = await helpers.get_user_context(message.dni_number, API_KEY_CREDITS_PANAMA)
-            
-            if 'msg' in user_context:
-                await session_manager.delete_session_by_id(message.conversation)
-                if 'msg-agent' in user_context:
-                    await b2chat.agent_handover(chat_manager, message.dni_number, message.conversation, user_context['msg-agent'], message.author)
-                return user_context['msg']
-                
-            answer_vec = await chains.provide_support_conv_chain(message.message, memory, user_context)
+            answer_vec = await timed_stage("llm", chains.provide_support_conv_chain(message.message, memory, user_context))
 
             for item in answer_vec:
                 for key, value in item.items():
@@ -377,86 +533,137 @@ async def execute_message(
                         #ret = "Un agente se pondrá en contacto contigo pronto."
                         await b2chat.agent_handover(chat_manager, message.dni_number, message.conversation, value, message.author)
                         print(f"Sending message to agent: {value}")
-    else:
-        user_context = await helpers.get_user_context(message.dni_number, API_KEY_CREDITS_PANAMA)
     
-        if 'msg' in user_context:
-            await session_manager.delete_session_by_id(message.conversation)
-            if 'msg-agent' in user_context:
-                await b2chat.agent_handover(chat_manager, message.dni_number, message.conversation, user_context['msg-agent'], message.author)
-            return user_context['msg']
+    if ret == " ":
+        ret = "Un agente se pondrá en contacto contigo pronto."
+
+    background.spawn(mongo_memory_manager.add_message_memory(ret, message.conversation, MessageType.AI, message.author), name="add-message-memory")
+    summarizer.schedule_summary(mongo_memory_manager, message.conversation)
+    metrics.observe("turn.total", time.perf_counter() - turn_start)
+
+    return str(ret)
+
+async def stream_support_answer(message: Message, memory, user_context: dict, chat_manager: ChatManager, turn_start: float) -> list[str]:
+    """
+    Streams the support chain and dispatches every element of its answer as soon as it is
+    complete: "Cliente" messages are sent to Twilio in order, "Agente" messages start the
+    agent handover alongside them. Handovers run one after another, like the sends, since
+    the first one opens the B2Chat chat the later ones post to. Returns the messages sent
+    to the client.
+    """
+    sent = []
+    last_send = None
+    last_handover = None
 
-        answer_vec = await chains.provide_support_conv_chain(message.message, memory, user_context)
+    async def run_after(previous: Optional[asyncio.Task], action: Callable[[], Awaitable[Any]]):
+        if previous is not None:
+            await previous
+        await action()
 
-        for item in answer_vec:
+    try:
+        async for item in chains.stream_support_conv_chain(message.message, memory, user_context):
             for key, value in item.items():
                 if key == "Cliente":
                     print(f"Sending message to client: {value}")
-                    ret = value
+                    if not sent:
+                        metrics.observe("turn.first_dispatch", time.perf_counter() - turn_start)
+                    sent.append(value)
+                    last_send = asyncio.create_task(run_after(last_send, lambda body=value: twilio_messaging.send_answer_to_client(body, message.conversation)))
                 elif key == "Agente":
-                    #ret = "Un agente se pondrá en contacto contigo pronto."
-                    await b2chat.agent_handover(chat_manager, message.dni_number, message.conversation, value, message.author)
                     print(f"Sending message to agent: {value}")
-    
-    if ret == " ":
-        ret = "Un agente se pondrá en contacto contigo pronto."
+                    last_handover = asyncio.create_task(run_after(last_handover, lambda initial_msg=value: b2chat.agent_handover(chat_manager, message.dni_number, message.conversation, initial_msg, message.author)))
+    finally:
+        await asyncio.gather(*(task for task in (last_handover, last_send) if task is not None))
 
-    await mongo_memory_manager.add_message_memory(ret, message.conversation, MessageType.AI, message.author)
-
-    return str(ret)
+    return sent
 
 if __name__ == "__main__":
     uvicorn.run(app, host="0.0.0.0", port=8000)
 
-async def media_flow(data_dict: dict, dni: str):
-        chat_manager = await get_chat_manager()
-        memory = await get_mongo_manager()
-
-        # Parse the 'Media' field from the JSON string
-        media_items = json.loads(data_dict['Media'])
-        chat_service_sid = data_dict['ChatServiceSid']
+MEDIA_CONCURRENCY = int(os.getenv("MEDIA_CONCURRENCY", "4"))
+# Shared by every job of the worker, bounds the downloads and uploads running at once
+_media_slots = asyncio.Semaphore(MEDIA_CONCURRENCY)
+MEDIA_DROPPED_MSG = f"No pudimos enviar uno de tus archivos al agente. Puede que sea demasiado grande (máximo {helpers.MEDIA_MAX_BYTES // (1024 * 1024)} MB), por favor intenta enviarlo de nuevo."
 
-        # Iterate over each media item
-        for media in media_items:
-            content_type = media.get("ContentType")
-            if content_type and content_type.startswith("image/"):
-                media = await twilio_messaging.fetch_media_by_sid(media['Sid'], chat_service_sid)
-                media = json.loads(media)
+async def upload_media(source_url: str, media_type: str) -> tuple[str, Optional[str]]:
+    """Relays one attachment to Supabase storage, returns the source url and the uploaded url."""
+    bucket_name = "wap_images" if media_type == "IMAGE" else "wap_files"
+    async with _media_slots:
+        return source_url, await helpers.fetch_and_upload_file(source_url, bucket_name, supabase_client, SUPABASE_URL, managers.media_index)
 
-                id = await chat_manager.get_chat_id(data_dict['ConversationSid']) 
-                if id:
-                    await b2chat.post_image_to_agent(chat_manager, media['links']['content_direct_temporary'], id, supabase_client, SUPABASE_URL)
-                    await memory.add_message_permament(media['links']['content_direct_temporary'], data_dict['ConversationSid'], MessageType.B2CHAT_CLIENT, data_dict['Author'])
+async def upload_twilio_media(media_sid: str, chat_service_sid: str, media_type: str) -> tuple[str, Optional[str]]:
+    media = await twilio_messaging.fetch_media_by_sid(media_sid, chat_service_sid)
+    media = json.loads(media)
+    return await upload_media(media['links']['content_direct_temporary'], media_type)
 
-                else:
-                    await b2chat.agent_handover(chat_manager, dni, data_dict['ConversationSid'], "Image", data_dict['Author'])
+def cancel_uploads(uploads: list[tuple[str, str, asyncio.Task]]):
+    for _, _, task in uploads:
+        task.cancel()
 
-                    id = await chat_manager.get_chat_id(data_dict['ConversationSid'])
-                    await b2chat.post_image_to_agent(chat_manager, media['links']['content_direct_temporary'], id, supabase_client, SUPABASE_URL)
-                    await memory.add_message_permament(media['links']['content_direct_temporary'], data_dict['ConversationSid'], MessageType.B2CHAT_CLIENT, data_dict['Author'])
-
-                    twilio_messaging.send_answer_to_client("Un agente se pondrá en contacto contigo pronto.", data_dict['ConversationSid'])
-
-            elif content_type and content_type.startswith("audio/"):
-                print(f"Found audio media: SID {media['Sid']}, Type {media['ContentType']}")
-                media = await twilio_messaging.fetch_media_by_sid(media['Sid'], chat_service_sid)
-                media = json.loads(media)
-
-                id = await chat_manager.get_chat_id(data_dict['ConversationSid']) 
-                if id:
-                    await b2chat.post_file_to_agent(chat_manager, media['links']['content_direct_temporary'], id, supabase_client, SUPABASE_URL)
-                    await memory.add_message_permament(media['links']['content_direct_temporary'], data_dict['ConversationSid'], MessageType.B2CHAT_CLIENT, data_dict['Author'])
-
-                else:
-                    await b2chat.agent_handover(chat_manager, dni, data_dict['ConversationSid'], "File", data_dict['Author'])
+async def relay_media_to_agent(chat_id: str, uploads: list[tuple[str, str, asyncio.Task]], conversation: str, author: str, progress: job_queue.JobProgress):
+    """
+    Posts the attachments to the agent chat and records them in the permanent history as
+    their uploads finish, always in the order the client sent them. `uploads` holds the
+    (job step, media type, upload task) of each attachment still to relay.
+    """
+    chat_manager = await get_chat_manager()
+    memory = await get_mongo_manager()
+    dropped = 0
+    for step, media_type, task in uploads:
+        source_url, uploaded_url = await task
+        if uploaded_url is None:
+            # Too large, or the download or upload failed; already logged by fetch_and_upload_file
+            await async_logger.warning(f"Attachment {source_url} of {conversation} could not be relayed to the agent")
+            metrics.incr("media.dropped")
+            dropped += 1
+            continue
+        send = b2chat.send_image_to_agent if media_type == "IMAGE" else b2chat.send_file_to_agent
+        await progress.once(step, lambda: asyncio.gather(
+            send(chat_manager, uploaded_url, chat_id),
+            memory.add_message_permament(source_url, conversation, MessageType.B2CHAT_CLIENT, author),
+        ))
+
+    if dropped:
+        await progress.once("media-dropped", lambda: twilio_messaging.send_answer_to_client(MEDIA_DROPPED_MSG, conversation))
+
+async def media_flow(data_dict: dict, dni: str, progress: job_queue.JobProgress):
+    """
+    Relays the attachments of a client message to the agent. The Twilio metadata fetches and
+    the uploads run concurrently, bounded by MEDIA_CONCURRENCY; the chat is resolved once.
+    """
+    chat_manager = await get_chat_manager()
+    conversation = data_dict['ConversationSid']
+    chat_service_sid = data_dict['ChatServiceSid']
+
+    uploads = []
+    for index, media in enumerate(json.loads(data_dict['Media'])):
+        content_type = media.get("ContentType")
+        if content_type and content_type.startswith("image/"):
+            media_type = "IMAGE"
+        elif content_type and content_type.startswith("audio/"):
+            print(f"Found audio media: SID {media['Sid']}, Type {media['ContentType']}")
+            media_type = "FILE"
+        else:
+            print(f"Found non-image media or unknown type: SID {media['Sid']}")
+            continue
+        if progress.done(f"media:{index}"):
+            continue
+        uploads.append((f"media:{index}", media_type, asyncio.create_task(upload_twilio_media(media['Sid'], chat_service_sid, media_type))))
 
-                    id = await chat_manager.get_chat_id(data_dict['ConversationSid'])
+    if not uploads and not progress.done("handover"):
+        return "Ok"
 
-                    await b2chat.post_file_to_agent(chat_manager, media['links']['content_direct_temporary'], id, supabase_client, SUPABASE_URL)
-                    await memory.add_message_permament(media['links']['content_direct_temporary'], data_dict['ConversationSid'], MessageType.B2CHAT_CLIENT, data_dict['Author'])
+    try:
+        id = await chat_manager.get_chat_id(conversation)
+        if not id:
+            await progress.once("handover", lambda: b2chat.agent_handover(chat_manager, dni, conversation, "Image" if uploads[0][1] == "IMAGE" else "File", data_dict['Author']))
+            id = await chat_manager.get_chat_id(conversation)
+        await relay_media_to_agent(id, uploads, conversation, data_dict['Author'], progress)
+    finally:
+        cancel_uploads(uploads)
 
-                    twilio_messaging.send_answer_to_client("Un agente se pondrá en contacto contigo pronto.", data_dict['ConversationSid']) 
-            else:
-                print(f"Found non-image media or unknown type: SID {media['Sid']}")
+    # Opened by this job, possibly in an earlier attempt
+    if progress.done("handover"):
+        await progress.once("reply", lambda: twilio_messaging.send_answer_to_client("Un agente se pondrá en contacto contigo pronto.", conversation))
 
-        return "Ok"
+    return "Ok"
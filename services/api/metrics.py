@@ -0,0 +1,43 @@
+import time
+from contextlib import contextmanager
+from typing import Callable
+
+_counters: dict[str, float] = {}
+_timings: dict[str, dict[str, float]] = {}
+_gauges: dict[str, Callable[[], float]] = {}
+
+def incr(name: str, value: float = 1):
+    _counters[name] = _counters.get(name, 0) + value
+
+def observe(name: str, value: float):
+    """Records one sample (usually seconds) of a timing or size metric."""
+    timing = _timings.get(name)
+    if timing is None:
+        timing = _timings[name] = {"count": 0, "total": 0.0, "max": 0.0, "last": 0.0}
+    timing["count"] += 1
+    timing["total"] += value
+    timing["max"] = max(timing["max"], value)
+    timing["last"] = value
+
+def register_gauge(name: str, fn: Callable[[], float]):
+    """Registers a callable evaluated every time a snapshot is taken."""
+    _gauges[name] = fn
+
+@contextmanager
+def timer(name: str):
+    start = time.perf_counter()
+    try:
+        yield
+    finally:
+        observe(name, time.perf_counter() - start)
+
+def snapshot() -> dict:
+    timings = {
+        name: {**timing, "avg": timing["total"] / timing["count"] if timing["count"] else 0.0}
+        for name, timing in _timings.items()
+    }
+    return {
+        "counters": dict(_counters),
+        "gauges": {name: fn() for name, fn in _gauges.items()},
+        "timings": timings,
+    }
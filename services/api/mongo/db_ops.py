@@ -1,10 +1,27 @@
+import os
+import random
+import asyncio
 from langchain.memory import ConversationBufferMemory
+from langchain_core.messages import SystemMessage
 from motor.motor_asyncio import AsyncIOMotorClient
-from typing import Optional
+from pymongo import UpdateOne
+from pymongo.errors import BulkWriteError
+from typing import Awaitable, Callable, Optional
 from datetime import datetime
 from enum import Enum
-from itertools import zip_longest
 from logger import async_logger
+from tokens import count_tokens
+import metrics
+
+MEMORY_WINDOW_TURNS = int(os.environ.get('MEMORY_WINDOW_TURNS', 10))
+MEMORY_TOKEN_BUDGET = int(os.environ.get('MEMORY_TOKEN_BUDGET', 0))
+MISSING_MESSAGE = "No response was generated, possible bug"
+RESPONSE_CACHE_TTL = int(os.environ.get('RESPONSE_CACHE_TTL', 7 * 24 * 3600))
+MEMORY_FLUSH_SIZE = int(os.environ.get('MEMORY_FLUSH_SIZE', 100))
+MEMORY_FLUSH_INTERVAL = float(os.environ.get('MEMORY_FLUSH_INTERVAL', 0.2))
+MEMORY_MAX_PENDING = int(os.environ.get('MEMORY_MAX_PENDING', 10000))
+ANALYTICS_SHARDS = int(os.environ.get('ANALYTICS_SHARDS', 8))
+ANALYTICS_FLUSH_INTERVAL = float(os.environ.get('ANALYTICS_FLUSH_INTERVAL', 10))
 
 class MongoDBManager:
     def __init__(self, mongo_uri: str, db_name: str):
@@ -90,6 +107,7 @@ class ChatManager:
     async def ensure_unique_indexes(self):
         await self.collection.create_index([("chat_id", 1)], unique=True)
         await self.collection.create_index([("conversation_number", 1)], unique=True)
+        await self.collection.create_index([("phone_number", 1)])
 
     async def insert_chat_id(self, chat_id: str, conversation: str, phone_number: str):
         document = {"chat_id": chat_id, "conversation_number": conversation, "direct_to_agent": True, "phone_number": phone_number}
@@ -103,6 +121,10 @@ class ChatManager:
         document = await self.collection.find_one({"chat_id": chat_id})
         return document.get("phone_number") if document else None
 
+    async def get_chat_contact(self, chat_id: str) -> Optional[dict]:
+        """Conversation number and phone number of a B2Chat chat, read with a single projected query."""
+        return await self.collection.find_one({"chat_id": chat_id}, {"_id": 0, "conversation_number": 1, "phone_number": 1})
+
     async def get_chat_id(self, conversation_number: str) -> Optional[str]:
         document = await self.collection.find_one({"conversation_number": conversation_number})
         return document.get("chat_id") if document else None
@@ -123,26 +145,141 @@ class ChatManager:
         result = await self.collection.update_one(filter, new_values)
 
 
-class AnalyticsManager:
-    def __init__(self, db: MongoDBManager):
-        self.collection = db.get_collection("analtics")
-
-    async def increment_count_month(self):
-        formatted_date = datetime.now().strftime('%m/%Y')
-        doc = await self.collection.find_one({'formatted_date': formatted_date})
-        if doc:
-            new_count = doc['counter'] + 1
-            await self.collection.update_one({'_id': doc['_id']}, {'$set': {'counter': new_count}})
-        else:
-            new_count = 1
-            await self.collection.insert_one({'formatted_date': formatted_date, 'counter': new_count})
+class DeferredFlush:
+    """
+    Runs `flush` in a background task `interval` seconds after `schedule` is first called,
+    or right away with `now`. `close` cancels the timer, waits for the flushes in flight
+    and flushes one last time.
+    """
+
+    def __init__(self, flush: Callable[[], Awaitable[None]], interval: float):
+        self._flush = flush
+        self.interval = interval
+        self._timer: Optional[asyncio.TimerHandle] = None
+        self._tasks: set[asyncio.Task] = set()
+
+    def schedule(self):
+        if self._timer is None:
+            self._timer = asyncio.get_running_loop().call_later(self.interval, self.now)
+
+    def now(self):
+        if self._timer is not None:
+            self._timer.cancel()
+            self._timer = None
+        task = asyncio.create_task(self._run())
+        self._tasks.add(task)
+        task.add_done_callback(self._tasks.discard)
+
+    async def _run(self):
+        try:
+            await self._flush()
+        except Exception:
+            # Already logged by the flush, what failed stays pending for the next one
+            pass
+
+    async def close(self):
+        if self._timer is not None:
+            self._timer.cancel()
+            self._timer = None
+        await asyncio.gather(*self._tasks, return_exceptions=True)
+        await self._flush()
 
-    async def get_current_year_data(self):
-        current_year = datetime.now().year
-        start_of_year = f"01/{current_year}"
-        end_of_year = f"12/{current_year}"
-        current_year_data = self.collection.find({'formatted_date': {'$gte': start_of_year, '$lte': end_of_year}})
-        return [doc async for doc in current_year_data]
+class AnalyticsManager:
+    """
+    Event counters with hourly and daily buckets in `analytics-counters`.
+
+    Increments are summed in memory and written every ANALYTICS_FLUSH_INTERVAL seconds
+    with one bulk write of upserts using $inc. Each bucket is spread over ANALYTICS_SHARDS
+    documents, picked at random per flush, so concurrent workers don't all update the same
+    document; reads sum the shards. Buckets are keyed by the UTC start of the hour or day.
+
+    The monthly counters written before, in `analtics`, are still read for the months the
+    new collection doesn't cover.
+    """
+
+    def __init__(self, db: MongoDBManager, shards: int = ANALYTICS_SHARDS, flush_interval: float = ANALYTICS_FLUSH_INTERVAL):
+        self.collection = db.get_collection("analytics-counters")
+        self.legacy_collection = db.get_collection("analtics")
+        self.shards = shards
+        self._pending: dict[tuple[str, str, datetime], int] = {}
+        self._lock = asyncio.Lock()
+        self._flusher = DeferredFlush(self.flush, flush_interval)
+
+    async def ensure_indexes(self):
+        await self.collection.create_index([("name", 1), ("granularity", 1), ("period", 1), ("shard", 1)], unique=True)
+        await self.legacy_collection.create_index([("formatted_date", 1)])
+
+    def increment(self, name: str = "messages", amount: int = 1):
+        """Counts `amount` events in the current hour and day. Never waits for Mongo."""
+        hour = datetime.utcnow().replace(minute=0, second=0, microsecond=0)
+        self._requeue([((name, "hour", hour), amount), ((name, "day", hour.replace(hour=0)), amount)])
+        self._flusher.schedule()
+
+    def _requeue(self, counters):
+        for key, amount in counters:
+            self._pending[key] = self._pending.get(key, 0) + amount
+
+    async def flush(self):
+        async with self._lock:
+            if not self._pending:
+                return
+            counters = list(self._pending.items())
+            self._pending = {}
+
+            operations = [
+                UpdateOne(
+                    {"name": name, "granularity": granularity, "period": period, "shard": random.randrange(self.shards)},
+                    {"$inc": {"count": amount}},
+                    upsert=True,
+                )
+                for (name, granularity, period), amount in counters
+            ]
+            try:
+                await self.collection.bulk_write(operations, ordered=False)
+            except BulkWriteError as error:
+                # Unordered: every upsert without an error was applied, retrying it would count it twice
+                self._requeue(counters[write_error["index"]] for write_error in error.details.get("writeErrors", []))
+                self._flusher.schedule()
+                await async_logger.error(f"Analytics flush failed for {len(error.details.get('writeErrors', []))} of {len(counters)} counters: {error.details.get('writeErrors', [])[:3]}")
+                raise
+            except Exception as error:
+                self._requeue(counters)
+                self._flusher.schedule()
+                await async_logger.error(f"Analytics flush failed, {len(self._pending)} counters pending: {error}")
+                raise
+
+    async def close(self):
+        """Writes the pending counts, called from the FastAPI lifespan on shutdown."""
+        await self._flusher.close()
+
+    async def get_counts(self, name: str, granularity: str, start: datetime, end: datetime) -> list[dict]:
+        """Counts per hour or day bucket in [start, end), oldest first."""
+        pipeline = [
+            {"$match": {"name": name, "granularity": granularity, "period": {"$gte": start, "$lt": end}}},
+            {"$group": {"_id": "$period", "count": {"$sum": "$count"}}},
+            {"$sort": {"_id": 1}},
+        ]
+        return [{"period": doc["_id"], "count": doc["count"]} async for doc in self.collection.aggregate(pipeline)]
+
+    async def get_current_year_data(self, name: str = "messages"):
+        """Monthly message counts of the current year as [{'formatted_date': 'MM/YYYY', 'counter': n}], by month."""
+        current_year = datetime.utcnow().year
+        pipeline = [
+            {"$match": {
+                "name": name,
+                "granularity": "day",
+                "period": {"$gte": datetime(current_year, 1, 1), "$lt": datetime(current_year + 1, 1, 1)},
+            }},
+            {"$group": {"_id": {"$month": "$period"}, "counter": {"$sum": "$count"}}},
+        ]
+        months = {doc["_id"]: doc["counter"] async for doc in self.collection.aggregate(pipeline)}
+
+        # Months counted before the sharded counters existed
+        legacy_keys = [f"{month:02d}/{current_year}" for month in range(1, 13)]
+        async for doc in self.legacy_collection.find({"formatted_date": {"$in": legacy_keys}}, {"formatted_date": 1, "counter": 1, "_id": 0}):
+            months.setdefault(int(doc["formatted_date"][:2]), doc["counter"])
+
+        return [{"formatted_date": f"{month:02d}/{current_year}", "counter": counter} for month, counter in sorted(months.items())]
 
 class SwitchManager:
     def __init__(self, db: MongoDBManager):
@@ -166,38 +303,246 @@ class SwitchManager:
             return document['chatbot_on']
         return True
 
+class ResponseCacheManager:
+    def __init__(self, db: MongoDBManager, ttl_seconds: int):
+        self.collection = db.get_collection("response-cache")
+        self.ttl_seconds = ttl_seconds
+
+    async def ensure_indexes(self):
+        await self.collection.create_index([("key", 1)], unique=True)
+        await self.collection.create_index([("prompt_version", 1), ("context", 1), ("hits", -1)])
+        await self.collection.create_index([("created_at", 1)], expireAfterSeconds=self.ttl_seconds)
+
+    async def find_by_key(self, key: str) -> Optional[dict]:
+        return await self.collection.find_one({"key": key}, {"response": 1, "_id": 0})
+
+    async def find_candidates(self, prompt_version: str, context: str, limit: int) -> list[dict]:
+        cursor = self.collection.find({"prompt_version": prompt_version, "context": context}, {"key": 1, "vector": 1, "response": 1, "_id": 0}).sort("hits", -1).limit(limit)
+        return await cursor.to_list(length=limit)
+
+    async def store(self, key: str, prompt_version: str, context: str, normalized: str, vector: dict[str, int], response: str):
+        await self.collection.update_one(
+            {"key": key},
+            {
+                "$setOnInsert": {"prompt_version": prompt_version, "context": context, "normalized": normalized, "vector": vector, "response": response, "created_at": datetime.utcnow()},
+                "$inc": {"misses": 1},
+            },
+            upsert=True,
+        )
+
+    async def record_hit(self, key: str):
+        await self.collection.update_one({"key": key}, {"$inc": {"hits": 1}})
+
+    async def purge_other_versions(self, prompt_version: str):
+        """Drops the answers produced by an older version of the prompt."""
+        await self.collection.delete_many({"prompt_version": {"$ne": prompt_version}})
+
+class MediaIndexManager:
+    """Maps the SHA-256 of an uploaded media file to its public Supabase url."""
+
+    def __init__(self, db: MongoDBManager):
+        self.collection = db.get_collection("media-index")
+
+    async def ensure_indexes(self):
+        await self.collection.create_index([("sha256", 1)], unique=True)
+
+    async def get_url(self, sha256: str) -> Optional[str]:
+        document = await self.collection.find_one({"sha256": sha256}, {"url": 1, "_id": 0})
+        return document.get("url") if document else None
+
+    async def store(self, sha256: str, url: str, bucket_name: str, size: int, content_type: str):
+        await self.collection.update_one(
+            {"sha256": sha256},
+            {"$setOnInsert": {"url": url, "bucket": bucket_name, "size": size, "content_type": content_type, "created_at": datetime.utcnow()}},
+            upsert=True,
+        )
+
 class MessageType(Enum):
     HUMAN = 'human'
     AI = 'ai'
     B2CHAT_AGENT = 'agent'
     B2CHAT_CLIENT = 'client'
 
+class WriteBehindBuffer:
+    """
+    Collects the inserts into one collection and writes them with unordered insert_many
+    calls, once `flush_size` documents are pending or `flush_interval` seconds after the
+    first one. Documents carry their own timestamps, so reads sorted by date are not
+    affected by the order in which a batch lands.
+
+    A batch that fails is put back and retried with the next flush; past `max_pending`
+    documents the oldest ones are dropped.
+    """
+
+    def __init__(self, collection, flush_size: int = MEMORY_FLUSH_SIZE, flush_interval: float = MEMORY_FLUSH_INTERVAL, max_pending: int = MEMORY_MAX_PENDING):
+        self.collection = collection
+        self.flush_size = flush_size
+        self.max_pending = max_pending
+        self._pending: list[dict] = []
+        self._lock = asyncio.Lock()
+        self._flusher = DeferredFlush(self.flush, flush_interval)
+
+        metrics.register_gauge(f"mongo.{collection.name}.pending_writes", lambda: len(self._pending))
+
+    def add(self, document: dict):
+        self._pending.append(document)
+        if len(self._pending) > self.max_pending:
+            dropped = len(self._pending) - self.max_pending
+            del self._pending[:dropped]
+            metrics.incr(f"mongo.{self.collection.name}.dropped_writes", dropped)
+        if len(self._pending) >= self.flush_size:
+            self._flusher.now()
+        else:
+            self._flusher.schedule()
+
+    async def flush(self):
+        """Writes every pending document. Returns once the writes queued before the call have landed."""
+        async with self._lock:
+            while self._pending:
+                batch = self._pending[:self.flush_size]
+                del self._pending[:len(batch)]
+                try:
+                    with metrics.timer(f"mongo.{self.collection.name}.flush"):
+                        await self.collection.insert_many(batch, ordered=False)
+                    metrics.observe(f"mongo.{self.collection.name}.batch_size", len(batch))
+                except BulkWriteError as error:
+                    # Unordered: every document without an error was written
+                    await async_logger.error(f"Batched insert into {self.collection.name} failed for {len(error.details.get('writeErrors', []))} of {len(batch)} documents: {error.details.get('writeErrors', [])[:3]}")
+                except Exception as error:
+                    self._pending[:0] = batch
+                    await async_logger.error(f"Batched insert into {self.collection.name} failed, {len(self._pending)} documents pending: {error}")
+                    self._flusher.schedule()
+                    raise
+
+    async def close(self):
+        await self._flusher.close()
+
 class AsyncMongoMemoryManager:
+    """
+    Chat history of every session. Inserts are written behind in batches; reads of the
+    history flush the pending inserts first so a turn always sees its own messages.
+    """
+
     def __init__(self, db: MongoDBManager):
         self.collection = db.get_collection("message-store")
         self.collection_permanent = db.get_collection("message-store-permanent")
+        self.collection_summary = db.get_collection("message-store-summary")
+        self._memory_writes = WriteBehindBuffer(self.collection)
+        self._permanent_writes = WriteBehindBuffer(self.collection_permanent)
+
+    async def flush(self):
+        """Read-your-writes barrier: waits until every insert queued so far is in Mongo."""
+        await asyncio.gather(self._memory_writes.flush(), self._permanent_writes.flush())
+
+    async def close(self):
+        """Writes the pending inserts, called from the FastAPI lifespan on shutdown."""
+        await asyncio.gather(self._memory_writes.close(), self._permanent_writes.close())
+
+    async def ensure_indexes(self):
+        await self.collection.create_index([("session", 1), ("date", 1)])
+        await self.collection_permanent.create_index([("session", 1), ("date", 1)])
+        await self.collection_summary.create_index([("session", 1)], unique=True)
         
-    async def load_buffer(self, session: str) -> ConversationBufferMemory:
+    async def load_buffer(self, session: str, max_turns: Optional[int] = MEMORY_WINDOW_TURNS, token_budget: Optional[int] = MEMORY_TOKEN_BUDGET) -> ConversationBufferMemory:
+        """
+        Loads the last `max_turns` human/ai turns of a session, oldest first, preceded by the
+        running summary of the older turns if there is one.
+        If `token_budget` is set, the oldest turns are dropped until the history fits in it.
+        A falsy `max_turns` loads the whole history.
+        """
+        await self._memory_writes.flush()
+        summary = await self.get_summary(session)
+        query = {"session": session}
+        if summary:
+            query["date"] = {"$gt": summary["covered_until"]}
+
+        limit = max_turns * 2 if max_turns else 0
+        cursor = self.collection.find(query, {"message": 1, "type": 1, "_id": 0}).sort("date", -1).limit(limit)
+        documents = await cursor.to_list(length=limit or None)
+        documents.reverse()
+
+        # The window may have cut a turn in half, don't show an answer without its question
+        if limit and len(documents) == limit and documents and documents[0].get("type") == MessageType.AI.value:
+            documents = documents[1:]
+
+        turns = self._pair_turns(documents)
+
+        if token_budget:
+            sizes = [count_tokens(human) + count_tokens(ai) for human, ai in turns]
+            while turns and sum(sizes) > token_budget:
+                turns.pop(0)
+                sizes.pop(0)
+
         buffer = ConversationBufferMemory()
-        cursor = self.collection.find({"session": session})
+        if summary:
+            buffer.chat_memory.add_message(SystemMessage(content=f"Summary of the earlier conversation: {summary['summary']}"))
+        for human, ai in turns:
+            buffer.save_context({"input": human}, {"output": ai})
+
+        return buffer
 
+    @staticmethod
+    def _pair_turns(documents: list[dict]) -> list[tuple[str, str]]:
+        """Pairs each human message with the ai message answering it, based on the message type."""
+        turns = []
+        pending_human = None
+        for document in documents:
+            if document.get("type") == MessageType.AI.value:
+                turns.append((pending_human if pending_human is not None else MISSING_MESSAGE, document["message"]))
+                pending_human = None
+            else:
+                if pending_human is not None:
+                    turns.append((pending_human, MISSING_MESSAGE))
+                pending_human = document["message"]
+
+        if pending_human is not None:
+            turns.append((pending_human, MISSING_MESSAGE))
+
+        return turns
+   
+    async def get_summary(self, session: str) -> Optional[dict]:
+        return await self.collection_summary.find_one({"session": session}, {"summary": 1, "covered_until": 1, "_id": 0})
+
+    async def save_summary(self, session: str, summary: str, covered_until: datetime):
+        await self.collection_summary.update_one(
+            {"session": session},
+            {"$set": {"summary": summary, "covered_until": covered_until, "updated": datetime.utcnow()}},
+            upsert=True,
+        )
+
+    async def count_unsummarized(self, session: str, since: Optional[datetime]) -> int:
+        await self._memory_writes.flush()
+        query = {"session": session}
+        if since:
+            query["date"] = {"$gt": since}
+        return await self.collection.count_documents(query)
+
+    async def get_messages_to_summarize(self, session: str, since: Optional[datetime], keep_recent: int) -> list[dict]:
+        """
+        Returns the messages newer than `since` except the last `keep_recent` ones, oldest
+        first, ending on a complete turn so no question gets separated from its answer.
+        """
+        await self._memory_writes.flush()
+        query = {"session": session}
+        if since:
+            query["date"] = {"$gt": since}
+        cursor = self.collection.find(query, {"message": 1, "type": 1, "date": 1, "_id": 0}).sort("date", 1)
         documents = await cursor.to_list(length=None)
-        if documents:
-            items = [document["message"] for document in documents]
-        else:
-            items = []
 
-        for item1, item2 in zip_longest(items[::2], items[1::2], fillvalue="No response was generated, possible bug"):
-            buffer.save_context({"input": item1}, {"output": item2})
+        documents = documents[:-keep_recent] if keep_recent else documents
+        while documents and documents[-1].get("type") != MessageType.AI.value:
+            documents.pop()
+        return documents
 
-        return buffer
-   
     async def clear(self, session: str):
+        # Pending inserts of the session must not land after the delete
+        await self._memory_writes.flush()
         await self.collection.delete_many({"session": session})
+        await self.collection_summary.delete_many({"session": session})
 
     async def add_message_memory(self, message: str, session: str, type: MessageType, number: str):
         type_var = type.value
-        await self.collection.insert_one({
+        self._memory_writes.add({
             "session": session,
             "message": message,
             "date": datetime.utcnow(),
@@ -208,7 +553,7 @@ class AsyncMongoMemoryManager:
 
     async def add_message_permament(self, message: str, session: str, type: MessageType, number: str):
         type_var = type.value
-        await self.collection_permanent.insert_one({
+        self._permanent_writes.add({
             "session": session,
             "message": message,
             "date": datetime.utcnow(),
@@ -216,3 +561,51 @@ class AsyncMongoMemoryManager:
             "phone_number": number
         })
 
+
+class Managers:
+    """
+    Holds one instance of every manager, shared by all requests of a worker.
+    bootstrap() declares the indexes of every collection once at startup.
+    """
+
+    EXPECTED_INDEXES = {
+        "session-dni": [[("session_id", 1)]],
+        "chat-b2c": [[("chat_id", 1)], [("conversation_number", 1)], [("phone_number", 1)]],
+        "message-store": [[("session", 1), ("date", 1)]],
+        "message-store-permanent": [[("session", 1), ("date", 1)]],
+        "message-store-summary": [[("session", 1)]],
+        "analtics": [[("formatted_date", 1)]],
+        "analytics-counters": [[("name", 1), ("granularity", 1), ("period", 1), ("shard", 1)]],
+        "response-cache": [[("key", 1)], [("prompt_version", 1), ("context", 1), ("hits", -1)], [("created_at", 1)]],
+        "media-index": [[("sha256", 1)]],
+    }
+
+    def __init__(self, db: MongoDBManager):
+        self.db = db
+        self.session = SessionManager(db)
+        self.chat = ChatManager(db)
+        self.switch = SwitchManager(db)
+        self.analytics = AnalyticsManager(db)
+        self.memory = AsyncMongoMemoryManager(db)
+        self.response_cache = ResponseCacheManager(db, RESPONSE_CACHE_TTL)
+        self.media_index = MediaIndexManager(db)
+
+    async def bootstrap(self):
+        await asyncio.gather(
+            self.session.ensure_unique_session_index(),
+            self.chat.ensure_unique_indexes(),
+            self.analytics.ensure_indexes(),
+            self.memory.ensure_indexes(),
+            self.response_cache.ensure_indexes(),
+            self.media_index.ensure_indexes(),
+        )
+        await self.validate_indexes()
+
+    async def validate_indexes(self):
+        """Raises if an index declared in EXPECTED_INDEXES is missing from its collection."""
+        for collection_name, expected in self.EXPECTED_INDEXES.items():
+            info = await self.db.get_collection(collection_name).index_information()
+            existing = [[tuple(field) for field in index["key"]] for index in info.values()]
+            for keys in expected:
+                if keys not in existing:
+                    raise RuntimeError(f"Missing index {keys} on collection '{collection_name}'")
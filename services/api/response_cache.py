@@ -0,0 +1,79 @@
+import os
+import math
+import hashlib
+from collections import Counter
+from langchain.memory import ConversationBufferMemory
+
+from mongo.db_ops import ResponseCacheManager
+import background
+import chains
+import metrics
+from intent import normalize
+
+# Only answer from the cache while the conversation has at most this many turns
+RESPONSE_CACHE_MAX_HISTORY_TURNS = int(os.environ.get('RESPONSE_CACHE_MAX_HISTORY_TURNS', 1))
+RESPONSE_CACHE_MAX_MESSAGE_LENGTH = int(os.environ.get('RESPONSE_CACHE_MAX_MESSAGE_LENGTH', 200))
+# Cosine similarity needed for a near-duplicate hit, 0 disables similarity lookups
+RESPONSE_CACHE_SIMILARITY = float(os.environ.get('RESPONSE_CACHE_SIMILARITY', 0))
+RESPONSE_CACHE_CANDIDATES = int(os.environ.get('RESPONSE_CACHE_CANDIDATES', 200))
+
+VECTOR_BUCKETS = 1024
+
+def embed(normalized: str) -> dict[str, int]:
+    """Local bag of character trigrams hashed into VECTOR_BUCKETS buckets, cheap enough to run on every message."""
+    padded = f" {normalized} "
+    trigrams = (padded[i:i + 3] for i in range(len(padded) - 2))
+    buckets = Counter(int(hashlib.md5(trigram.encode()).hexdigest()[:8], 16) % VECTOR_BUCKETS for trigram in trigrams)
+    return {str(bucket): count for bucket, count in buckets.items()}
+
+def cosine(a: dict[str, int], b: dict[str, int]) -> float:
+    dot = sum(value * b.get(key, 0) for key, value in a.items())
+    norm = math.sqrt(sum(v * v for v in a.values())) * math.sqrt(sum(v * v for v in b.values()))
+    return dot / norm if norm else 0.0
+
+def conversation_context(memory: ConversationBufferMemory) -> str:
+    """
+    Hash of the last bot message, part of every cache key: a short answer like "si" or "ok"
+    only means the same thing after the same question.
+    """
+    last_ai = next((message.content for message in reversed(memory.chat_memory.messages) if message.type == "ai"), "")
+    return hashlib.sha256(normalize(last_ai).encode()).hexdigest()[:16]
+
+def is_cacheable(message: str, memory: ConversationBufferMemory) -> bool:
+    # The answer may depend on the history, only cache the first turns of a conversation
+    if len(memory.chat_memory.messages) > RESPONSE_CACHE_MAX_HISTORY_TURNS * 2:
+        return False
+    return 0 < len(message) <= RESPONSE_CACHE_MAX_MESSAGE_LENGTH
+
+async def get_dni_conv_answer(cache: ResponseCacheManager, message: str, memory: ConversationBufferMemory) -> str:
+    """
+    chains.get_dni_conv_chain behind a response cache keyed on the normalized message, the
+    last bot message and the prompt version, optionally matching near duplicates of the
+    message by trigram similarity among the answers given after the same bot message.
+    """
+    if not is_cacheable(message, memory):
+        return await chains.get_dni_conv_chain(message, memory)
+
+    prompt_version = chains.prompt_version("dni_conversation")
+    normalized = normalize(message)
+    context = conversation_context(memory)
+    key = hashlib.sha256(f"{prompt_version}:{context}:{normalized}".encode()).hexdigest()
+
+    cached = await cache.find_by_key(key)
+    if cached is None and RESPONSE_CACHE_SIMILARITY > 0:
+        vector = embed(normalized)
+        best_score = 0.0
+        for candidate in await cache.find_candidates(prompt_version, context, RESPONSE_CACHE_CANDIDATES):
+            score = cosine(vector, candidate.get("vector", {}))
+            if score >= RESPONSE_CACHE_SIMILARITY and score > best_score:
+                best_score, cached, key = score, candidate, candidate["key"]
+
+    if cached is not None:
+        metrics.incr("response_cache.hit")
+        background.spawn(cache.record_hit(key), name="response-cache-hit")
+        return cached["response"]
+
+    metrics.incr("response_cache.miss")
+    response = await chains.get_dni_conv_chain(message, memory)
+    background.spawn(cache.store(key, prompt_version, context, normalized, embed(normalized), response), name="response-cache-store")
+    return response
@@ -0,0 +1,44 @@
+import os
+from mongo.db_ops import AsyncMongoMemoryManager, MessageType, MEMORY_WINDOW_TURNS
+import background
+import chains
+
+# Fold history into the summary once more than this many turns are not summarized yet
+SUMMARY_TRIGGER_TURNS = int(os.environ.get('SUMMARY_TRIGGER_TURNS', MEMORY_WINDOW_TURNS + 6))
+
+_in_progress: set[str] = set()
+
+def schedule_summary(memory: AsyncMongoMemoryManager, session: str):
+    """Starts a background summarization for the session unless one is already running."""
+    if session in _in_progress:
+        return
+    _in_progress.add(session)
+    background.spawn(_summarize(memory, session), name="summarize-history")
+
+async def _summarize(memory: AsyncMongoMemoryManager, session: str):
+    try:
+        await maybe_summarize(memory, session)
+    finally:
+        _in_progress.discard(session)
+
+async def maybe_summarize(memory: AsyncMongoMemoryManager, session: str):
+    """
+    Folds every turn older than the last MEMORY_WINDOW_TURNS into the persisted running
+    summary, once more than SUMMARY_TRIGGER_TURNS turns are waiting to be summarized.
+    """
+    summary = await memory.get_summary(session)
+    covered_until = summary["covered_until"] if summary else None
+
+    if await memory.count_unsummarized(session, covered_until) <= SUMMARY_TRIGGER_TURNS * 2:
+        return
+
+    documents = await memory.get_messages_to_summarize(session, covered_until, keep_recent=MEMORY_WINDOW_TURNS * 2)
+    if not documents:
+        return
+
+    new_lines = "\n".join(
+        f"{'AI' if document['type'] == MessageType.AI.value else 'Human'}: {document['message']}"
+        for document in documents
+    )
+    new_summary = await chains.summarize_history(summary["summary"] if summary else "", new_lines)
+    await memory.save_summary(session, new_summary, documents[-1]["date"])
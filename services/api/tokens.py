@@ -0,0 +1,11 @@
+from functools import lru_cache
+import tiktoken
+
+@lru_cache(maxsize=1)
+def _encoding() -> tiktoken.Encoding:
+    # cl100k_base is the encoding of the gpt-4 and gpt-3.5 model families
+    return tiktoken.get_encoding("cl100k_base")
+
+def count_tokens(text: str) -> int:
+    """Counts the tokens of a text as the OpenAI chat models see it."""
+    return len(_encoding().encode(text, disallowed_special=()))
@@ -1,28 +1,116 @@
 import os
-from twilio.rest import Client
+import asyncio
+import random
+from typing import Optional
 import aiohttp
+import http_sessions
+from logger import async_logger
 
 account_sid = os.environ.get('TWILIO_ACCOUNT_SID')
 auth_token = os.environ.get('TWILIO_AUTH_TOKEN')
 
-def send_answer_to_client(body: str, conversation: str):
-    client = Client(account_sid, auth_token)
+SEND_CONCURRENCY = int(os.environ.get('TWILIO_SEND_CONCURRENCY', 8))
+SEND_QUEUE_SIZE = int(os.environ.get('TWILIO_SEND_QUEUE_SIZE', 1000))
+SEND_MAX_RETRIES = int(os.environ.get('TWILIO_SEND_MAX_RETRIES', 4))
+SEND_BACKOFF_BASE = float(os.environ.get('TWILIO_SEND_BACKOFF_BASE', 0.5))
 
-    message = client.conversations \
-                .v1 \
-                .conversations(conversation) \
-                .messages \
-                .create(author='creditspanama-chatbot', body=body)
+RETRYABLE_STATUSES = {429, 500, 502, 503, 504}
+# Raised before the request went out, so retrying can't create the message twice.
+# aiohttp >= 3.10 reports connect timeouts apart from read timeouts.
+CONNECTION_ERRORS = (aiohttp.ClientConnectorError,) + ((aiohttp.ConnectionTimeoutError,) if hasattr(aiohttp, "ConnectionTimeoutError") else ())
 
-    print(message.sid)
+_auth = aiohttp.BasicAuth(login=account_sid or '', password=auth_token or '')
+_send_queue: Optional[asyncio.Queue] = None
+_send_workers: list[asyncio.Task] = []
+
+async def start_sender():
+    """
+    Creates the worker tasks draining the send queue. Must be called once per worker
+    process from the FastAPI lifespan, after http_sessions.init_sessions().
+    """
+    global _send_queue
+    _send_queue = asyncio.Queue(maxsize=SEND_QUEUE_SIZE)
+    for _ in range(SEND_CONCURRENCY):
+        _send_workers.append(asyncio.create_task(_send_worker()))
+
+async def stop_sender():
+    """Waits for queued messages to be delivered, then stops the workers."""
+    global _send_queue
+    if _send_queue is not None:
+        await _send_queue.join()
+    for worker in _send_workers:
+        worker.cancel()
+    await asyncio.gather(*_send_workers, return_exceptions=True)
+    _send_workers.clear()
+    _send_queue = None
+
+async def send_answer_to_client(body: str, conversation: str) -> Optional[str]:
+    """
+    Queues a message for the Twilio conversation and waits until it has been delivered.
+    Returns the message sid, or None if delivery failed after all retries. Raises
+    RuntimeError when the sender is not running.
+    """
+    if _send_queue is None:
+        raise RuntimeError(f"twilio_messaging sender is not running, message to {conversation} not sent")
+    future = asyncio.get_running_loop().create_future()
+    await _send_queue.put((body, conversation, future))
+    return await future
+
+async def _send_worker():
+    while True:
+        body, conversation, future = await _send_queue.get()
+        try:
+            sid = await _create_message(body, conversation)
+            if not future.done():
+                future.set_result(sid)
+        except Exception as error:
+            await async_logger.error(f"twilio_messaging._send_worker() failed to send to {conversation}: {error}")
+            if not future.done():
+                future.set_result(None)
+        finally:
+            _send_queue.task_done()
+
+async def _create_message(body: str, conversation: str) -> Optional[str]:
+    url = f"https://conversations.twilio.com/v1/Conversations/{conversation}/Messages"
+    data = {"Author": "creditspanama-chatbot", "Body": body}
+
+    for attempt in range(SEND_MAX_RETRIES + 1):
+        try:
+            async with http_sessions.get_session("twilio").post(url, data=data, auth=_auth) as response:
+                if response.status in (200, 201):
+                    json_response = await response.json()
+                    print(json_response.get('sid'))
+                    return json_response.get('sid')
+
+                if response.status not in RETRYABLE_STATUSES:
+                    await async_logger.error(f"twilio_messaging.send_answer_to_client() response:{response.status} {await response.text()}")
+                    return None
+
+                retry_after = response.headers.get('Retry-After')
+        except CONNECTION_ERRORS as error:
+            await async_logger.warning(f"twilio_messaging.send_answer_to_client() connection error: {error}")
+            retry_after = None
+        except (aiohttp.ClientError, asyncio.TimeoutError) as error:
+            # The POST may have reached Twilio and created the message, a retry could send it twice
+            await async_logger.error(f"twilio_messaging.send_answer_to_client() failed after sending to {conversation}, not retrying: {error!r}")
+            return None
+
+        if attempt == SEND_MAX_RETRIES:
+            break
+
+        delay = SEND_BACKOFF_BASE * (2 ** attempt) + random.uniform(0, SEND_BACKOFF_BASE)
+        if retry_after and retry_after.isdigit():
+            delay = max(delay, float(retry_after))
+        await asyncio.sleep(delay)
+
+    await async_logger.error(f"twilio_messaging.send_answer_to_client() gave up on {conversation} after {SEND_MAX_RETRIES} retries")
+    return None
 
 async def fetch_media_by_sid(media_sid: str, chat_service_sid: str):
     url = f"https://mcs.us1.twilio.com/v1/Services/{chat_service_sid}/Media/{media_sid}"
-    auth = aiohttp.BasicAuth(login=account_sid, password=auth_token)
-
-    async with aiohttp.ClientSession(auth=auth) as session:
-        async with session.get(url) as response:
-            if response.status == 200:
-                return await response.text()  # or response.json() if the response is JSON
-            else:
-                return f"Error: {response.status}"
+
+    async with http_sessions.get_session("twilio").get(url, auth=_auth) as response:
+        if response.status == 200:
+            return await response.text()  # or response.json() if the response is JSON
+        else:
+            return f"Error: {response.status}"